@@ -1,38 +1,237 @@
+import time
+
+# The startup timeline is measured from here, see `StartupTimeline`
+STARTUP_BEGAN = time.perf_counter()
+
 import asyncio
 import colorsys
+import hashlib
+import heapq
+import importlib
+import json
+import logging
+import math
+import os
+import random
+import re
 import sys
+import threading
 import TouchPortalAPI as TP
-import yaml
-from functools import wraps
-from typing import Any, Awaitable, Dict, Optional, Tuple, TypeVar, Union
-from argparse import ArgumentParser
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache, wraps
+from typing import TYPE_CHECKING, Any, Callable, Coroutine, Deque, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
 from TouchPortalAPI.logger import Logger
-from tapo import ApiClient
+
+if TYPE_CHECKING:
+    from tapo import ApiClient
+
+# `yaml` and `tapo` are only needed once TP sent the settings. They are imported on the
+# Tapo loop while the main thread connects to TP, see `preload_modules`.
+DEFERRED_MODULES = ('yaml', 'tapo')
+
+STARTUP_IMPORTED = time.perf_counter()
 
 # Supported device types and actions
 
-SUPPORTED_DEVICE_TYPES = {
-    'L510': ['On_Off', 'Toggle', 'Bright'],
-    'L520': ['On_Off', 'Toggle', 'Bright'],
-    'L610': ['On_Off', 'Toggle', 'Bright'],
-    'L530': ['On_Off', 'Toggle', 'Bright', 'RGB', 'ColorTemperature', 'RGB_Bright'],
-    'L630': ['On_Off', 'Toggle', 'Bright', 'RGB', 'ColorTemperature', 'RGB_Bright']
+class DeviceType:
+    # A supported model: the `ApiClient` method creating its handler and the actions it supports
+    __slots__ = ('model', 'factory', 'actions', 'color')
+
+    def __init__(self, model: str, factory: str, actions: Iterable[str]) -> None:
+        self.model = model
+        self.factory = factory
+        self.actions: FrozenSet[str] = frozenset(actions)
+        self.color = 'RGB' in self.actions
+
+PLUG_ACTIONS = ('On_Off', 'Toggle')
+LIGHT_ACTIONS = PLUG_ACTIONS + ('Bright', 'Effect')
+COLOR_LIGHT_ACTIONS = LIGHT_ACTIONS + ('RGB', 'ColorTemperature', 'RGB_Bright')
+
+# Supporting a new model only takes an entry here, as long as `tapo` has a handler for it
+DEVICE_TYPES = {device_type.model: device_type for device_type in (
+    DeviceType('L510', 'l510', LIGHT_ACTIONS),
+    DeviceType('L520', 'l520', LIGHT_ACTIONS),
+    DeviceType('L610', 'l610', LIGHT_ACTIONS),
+    DeviceType('L530', 'l530', COLOR_LIGHT_ACTIONS),
+    DeviceType('L535', 'l535', COLOR_LIGHT_ACTIONS),
+    DeviceType('L630', 'l630', COLOR_LIGHT_ACTIONS),
+    DeviceType('L900', 'l900', COLOR_LIGHT_ACTIONS),
+    DeviceType('L920', 'l920', COLOR_LIGHT_ACTIONS),
+    DeviceType('L930', 'l930', COLOR_LIGHT_ACTIONS),
+    DeviceType('P100', 'p100', PLUG_ACTIONS),
+    DeviceType('P105', 'p105', PLUG_ACTIONS),
+    DeviceType('P110', 'p110', PLUG_ACTIONS),
+    DeviceType('P115', 'p115', PLUG_ACTIONS),
+)}
+
+# Every action any model supports
+DEVICE_ACTIONS = frozenset(action for device_type in DEVICE_TYPES.values() for action in device_type.actions)
+
+# Plugin options, can be overridden from the `options` section of the config file
+
+DEFAULT_OPTIONS = {
+    'state_ttl': 30.0,  # seconds a cached device state is trusted before a live read
+    'poll_interval_idle': 30.0,  # seconds between state polls while the deck is idle
+    'poll_interval_active': 2.0,  # seconds between state polls right after an action
+    'poll_active_window': 15.0,  # seconds after an action during which polling stays fast
+    'poll_concurrency': 8,  # maximum devices polled at the same time
+    'connect_wait': 5.0,  # seconds an action waits for a connection in progress
+    'reconnect_backoff_min': 1.0,  # seconds before the first reconnect attempt
+    'reconnect_backoff_max': 300.0,  # upper bound of the reconnect backoff
+    'connect_timeout': 5.0,  # seconds a handshake may take before it counts as failed
+    'request_timeout': 3.0,  # seconds a device request may take before it counts as failed
+    'breaker_threshold': 3,  # consecutive failures that open the circuit of a device
+    'group_concurrency': 16,  # maximum group members a single group action talks to at the same time
+    'batch_window': 0.05,  # seconds a color light waits for more changes to fuse into one request
+    'metrics_interval': 60.0,  # seconds between metrics reports, 0 disables them
+    'metrics_states': False,  # publish latency and throughput summaries as TP states
+    'metrics_file': '',  # Prometheus text file for the metrics, relative to the config file
+    'startup_cache_ttl': 86400.0,  # seconds a cached light state is shown at startup, 0 disables the cache
+    'config_watch_interval': 2.0,  # seconds between checks of the config file for changes, 0 disables reloading
+    'session_refresh_age': 72000.0,  # seconds after which a light's session is renewed ahead of its expiry, 0 disables it
+    'effect_max_fps': 10.0,  # most frames per second an effect sends to a light, slower lights get fewer
+    'connector_max_rate': 10.0,  # most slider updates per second sent to a light, slower lights get fewer
+    'connector_min_step': 2,  # slider steps (0-100) a slider must move before a new value is sent while dragging
+    'request_concurrency': 16,  # most requests in flight over all lights at the same time
+    'rate_limit_max': 20.0,  # most requests per second sent to a light
+    'rate_limit_min': 0.5,  # requests per second a struggling light is slowed down to at most
+    'rate_limit_burst': 10.0,  # requests a light may get back to back before the rate applies
+    'rate_limit_latency': 1.0,  # seconds above which an answer counts as slow and lowers the rate
+    'write_behind_ttl': 600.0,  # seconds changes for an unreachable light are kept to apply once it is back, 0 disables it
+    'skip_matching_commands': True,  # skip requests when the trusted state of the light already matches them
+    'discovery_interval': 300.0,  # least seconds between LAN scans for lights that stopped answering, 0 disables discovery
+    'discovery_subnets': '',  # comma separated broadcast or light addresses to scan, empty scans the /24 of every configured light
+    'discovery_timeout': 2,  # seconds each address is listened to for answers (1-60)
+    'discovery_concurrency': 4,  # most addresses scanned at the same time
+    'discovery_budget': 10.0,  # seconds a whole scan may take, addresses not scanned by then are skipped
+    'discovery_propose': False,  # log config entries for supported devices found on the LAN but missing in the config
+    'max_connections': 0,  # most lights connected at the same time, least recently used idle lights are disconnected, 0 for no limit
 }
 
-R = TypeVar('R')
+# Least seconds between two rounds of a background loop, shorter intervals in the options
+# are raised to it so a loop with nothing to do doesn't spin on the Tapo event loop
+LOOP_INTERVAL_MIN = 0.5
+
+# Keys of the `rate_limits` config section, overriding the rate limit options per device type
+RATE_LIMIT_KEYS = {
+    'max_rate': 'rate_limit_max',
+    'min_rate': 'rate_limit_min',
+    'burst': 'rate_limit_burst',
+    'latency': 'rate_limit_latency',
+}
+
+# Options also settable per device type in the `rate_limits` config section
+RATE_LIMIT_OPTIONS = frozenset(RATE_LIMIT_KEYS.values())
+
+# Config file sections that do not describe devices
+CONFIG_SECTIONS = {'options', 'groups', 'rate_limits', 'accounts'}
+
+# Account of lights without an `account`, its credentials come from the plugin settings
+DEFAULT_ACCOUNT = ''
+
+# Actions that also accept a device group as target
+GROUP_ACTIONS = {'On_Off', 'Bright', 'RGB', 'ColorTemperature', 'RGB_Bright', 'Effect'}
+
+# Saved scenes and the startup cache are stored next to the config file
+SCENE_FILE_NAME = 'tapo-scenes.json'
+STARTUP_CACHE_FILE_NAME = 'tapo-cache.json'
+STARTUP_CACHE_SAVE_INTERVAL = 300.0  # seconds between startup cache saves while running
+DISCOVERY_FILE_NAME = 'tapo-discovery.json'
+
+# Distinct action colors kept converted to hue and saturation
+COLOR_CACHE_SIZE = 256
+
+# Tapo event loop
+
+class TapoEventLoop:
+    # Owns a single long-lived asyncio loop running on a dedicated thread.
+    # Every Tapo client and light handler is created and used on this loop only,
+    # TP callbacks (running on TP worker threads) hand work to it through `submit`.
+
+    def __init__(self, name: str = 'TapoEventLoop') -> None:
+        self._name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    @property
+    def loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        return self._loop
 
-def async_to_sync(func: Awaitable[R]) -> R:
-    # Wraps `asyncio.run` on an async function making it sync callable.
+    def is_running(self) -> bool:
+        return self._loop is not None and self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.is_running():
+            return
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            # Cancel whatever is still pending so nothing outlives the loop
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+            self._loop = None
+
+    def call_soon(self, callback: Callable[..., Any], *args) -> None:
+        # Thread-safe: runs a plain callback on the loop without waiting for it
+        if not self.is_running():
+            raise RuntimeError(f'{self._name} is not running')
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def submit(self, coro: Coroutine[Any, Any, Any]) -> Future:
+        # Thread-safe: schedules `coro` on the loop and returns a concurrent Future
+        if not self.is_running():
+            coro.close()
+            raise RuntimeError(f'{self._name} is not running')
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        loop, thread = self._loop, self._thread
+        if loop is None or thread is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not threading.current_thread():
+            thread.join(timeout)
+        self._thread = None
+
+g_tapo_loop = TapoEventLoop()
+
+def run_on_tapo_loop(func: Callable[..., Coroutine[Any, Any, Any]]) -> Callable[..., Future]:
+    # Makes an async function sync callable by submitting it to the Tapo event loop.
+    # The caller gets a Future back and is not blocked while the Tapo I/O runs.
     if not asyncio.iscoroutinefunction(func):
         raise TypeError(f'{func} is not a coroutine function')
     @wraps(func)
-    def wrapper(*args, **kwargs):
-        try:
-            return asyncio.get_event_loop().run_until_complete(func(*args, **kwargs))
-        except RuntimeError:
-            return asyncio.new_event_loop().run_until_complete(func(*args, **kwargs))
+    def wrapper(*args, **kwargs) -> Future:
+        future = g_tapo_loop.submit(func(*args, **kwargs))
+        future.add_done_callback(log_future_exception)
+        return future
     return wrapper
 
+def log_future_exception(future: Future) -> None:
+    if future.cancelled():
+        return
+    if (e := future.exception()):
+        g_log.warning(f'Error in Tapo task: {repr(e)}')
+
 # Touch Portal API > Plugin definition
 
 __version__ = 1.1
@@ -40,7 +239,7 @@ __version__ = 1.1
 PLUGIN_ID = 'mx.alfador.touchportal.TPLinkTapoPlugin'
 
 TP_PLUGIN_INFO = {
-    'sdk': 3,
+    'sdk': 4,  # connectors need at least SDK 4
     'version': int(float(__version__) * 100),  # TP only recognizes integer version numbers
     'name': 'TPLink Tapo - alFadorMX',
     'id': PLUGIN_ID,
@@ -161,7 +360,7 @@ TP_PLUGIN_ACTIONS = {
             'bright': {
                 'id': PLUGIN_ID + '.Actions.Bright.Data.Bright',
                 'type': 'number',
-                'minValue': 0,
+                'minValue': 1,
                 'maxValue': 100,
                 'allowDecimals': False,
                 'label': 'Brightness',
@@ -245,18 +444,199 @@ TP_PLUGIN_ACTIONS = {
             'bright': {
                 'id': PLUGIN_ID + '.Actions.RGB_Bright.Data.Bright',
                 'type': 'number',
+                'minValue': 1,
+                'maxValue': 100,
+                'allowDecimals': False,
+                'label': 'Brightness',
+                'default': 100
+            },
+        }
+    },
+    'Effect': {
+        'category': 'general',
+        'id': PLUGIN_ID + '.Actions.Effect',
+        'name': 'Run Effect',
+        'prefix': TP_PLUGIN_CATEGORIES['general']['name'],
+        'type': 'communicate',
+        'tryInline': True,
+        'doc': 'Runs a **Fade**, **Crossfade**, **Color Cycle** or **Breathe** effect on the device, or stops it',
+        'format': 'Run $[2] on $[1] over $[3] seconds to brightness $[4] and color $[5]',
+        'data': {
+            'device_list': {
+                'id': PLUGIN_ID + '.Actions.Effect.Data.DeviceList',
+                'type': 'choice',
+                'label': 'choice',
+                'valueChoices': []
+            },
+            'effect': {
+                'id': PLUGIN_ID + '.Actions.Effect.Data.Effect',
+                'type': 'choice',
+                'label': 'choice',
+                'valueChoices': [
+                    'Fade Brightness',
+                    'Crossfade Color',
+                    'Color Cycle',
+                    'Breathe',
+                    'Stop'
+                ]
+            },
+            'duration': {
+                'id': PLUGIN_ID + '.Actions.Effect.Data.Duration',
+                'type': 'number',
                 'minValue': 0,
+                'maxValue': 3600,
+                'allowDecimals': True,
+                'label': 'Duration',
+                'default': 2
+            },
+            'bright': {
+                'id': PLUGIN_ID + '.Actions.Effect.Data.Bright',
+                'type': 'number',
+                'minValue': 1,
                 'maxValue': 100,
                 'allowDecimals': False,
                 'label': 'Brightness',
                 'default': 100
             },
+            'rgb': {
+                'id': PLUGIN_ID + '.Actions.Effect.Data.RGB',
+                'type': 'color',
+                'label': 'color',
+                'default': '#FF0000FF'
+            },
+        }
+    },
+    'SaveScene': {
+        'category': 'general',
+        'id': PLUGIN_ID + '.Actions.SaveScene',
+        'name': 'Save Scene',
+        'prefix': TP_PLUGIN_CATEGORIES['general']['name'],
+        'type': 'communicate',
+        'tryInline': True,
+        'doc': 'Saves the current state of all lights as a **Scene**',
+        'format': 'Save all lights as scene $[1]',
+        'data': {
+            'scene': {
+                'id': PLUGIN_ID + '.Actions.SaveScene.Data.Scene',
+                'type': 'text',
+                'label': 'Scene',
+                'default': ''
+            },
+        }
+    },
+    'RecallScene': {
+        'category': 'general',
+        'id': PLUGIN_ID + '.Actions.RecallScene',
+        'name': 'Recall Scene',
+        'prefix': TP_PLUGIN_CATEGORIES['general']['name'],
+        'type': 'communicate',
+        'tryInline': True,
+        'doc': 'Restores all lights to a saved **Scene**',
+        'format': 'Recall scene $[1]',
+        'data': {
+            'scene': {
+                'id': PLUGIN_ID + '.Actions.RecallScene.Data.Scene',
+                'type': 'choice',
+                'label': 'choice',
+                'valueChoices': []
+            },
+        }
+    },
+}
+
+# Connector IDs are kept short: a slider update carries `pc_<plugin ID>_<connector ID>|<data ID>=<device name>`,
+# which Touch Portal caps at `CONNECTOR_UPDATE_ID_MAX` characters
+TP_PLUGIN_CONNECTORS = {
+    'Bright': {
+        'category': 'general',
+        'id': PLUGIN_ID + '.Conn.Bright',
+        'name': 'Brightness Slider',
+        'format': 'Brightness of $[1]',
+        'data': {
+            'device_list': {
+                'id': PLUGIN_ID + '.Conn.Bright.Dev',
+                'type': 'choice',
+                'label': 'choice',
+                'valueChoices': []
+            },
+        }
+    },
+    'ColorTemperature': {
+        'category': 'general',
+        'id': PLUGIN_ID + '.Conn.Temp',
+        'name': 'Color Temperature Slider',
+        'format': 'Color temperature of $[1]',
+        'data': {
+            'device_list': {
+                'id': PLUGIN_ID + '.Conn.Temp.Dev',
+                'type': 'choice',
+                'label': 'choice',
+                'valueChoices': []
+            },
+        }
+    },
+    'Hue': {
+        'category': 'general',
+        'id': PLUGIN_ID + '.Conn.Hue',
+        'name': 'Hue Slider',
+        'format': 'Hue of $[1]',
+        'data': {
+            'device_list': {
+                'id': PLUGIN_ID + '.Conn.Hue.Dev',
+                'type': 'choice',
+                'label': 'choice',
+                'valueChoices': []
+            },
         }
     },
+    'Saturation': {
+        'category': 'general',
+        'id': PLUGIN_ID + '.Conn.Sat',
+        'name': 'Saturation Slider',
+        'format': 'Saturation of $[1]',
+        'data': {
+            'device_list': {
+                'id': PLUGIN_ID + '.Conn.Sat.Dev',
+                'type': 'choice',
+                'label': 'choice',
+                'valueChoices': []
+            },
+        }
+    },
+}
+
+# Action a device must support to be offered for a connector
+CONNECTOR_ACTIONS = {
+    'Bright': 'Bright',
+    'ColorTemperature': 'ColorTemperature',
+    'Hue': 'RGB',
+    'Saturation': 'RGB',
 }
 
+# Every device list choice and the action whose devices it lists, built once from the
+# definitions above rather than on each config load
+DEVICE_LIST_CHOICES: Tuple[Tuple[str, str], ...] = tuple(
+    [(definition['data']['device_list']['id'], action) for action, definition in TP_PLUGIN_ACTIONS.items()
+     if action in DEVICE_ACTIONS and 'device_list' in definition['data']] +
+    [(TP_PLUGIN_CONNECTORS[connector]['data']['device_list']['id'], action) for connector, action in CONNECTOR_ACTIONS.items()]
+)
+
+# Device states are created dynamically per device, see `publish_device_states`
 TP_PLUGIN_STATES = {}
 
+DEVICE_STATES = {
+    'On': 'On / Off',
+    'Brightness': 'Brightness',
+    'Color': 'Color',
+    'Reachable': 'Reachable',
+    'Circuit': 'Circuit',
+    'Latency': 'Latency p95 (ms)',
+}
+
+GROUP_STATES = {
+    'Failed': 'Failed Members',
+}
+
 TP_PLUGIN_EVENTS = {}
 
 try:
@@ -272,211 +652,2636 @@ except Exception as e:
     sys.exit(f'Could not create TP Client, exiting. Error was:\n{repr(e)}')
 
 g_log = Logger(name = PLUGIN_ID)
-Device = Dict[str, Optional[Union[str, Any]]]
-g_device_list: Dict[str, Device] = {}
-g_tapo_client: ApiClient = None
+
+class Device:
+    # A device from the config file and everything the plugin keeps for it. `ipaddress`
+    # is where the light is reached, which differs from `configured_ip` once discovery
+    # found it elsewhere. `device_id` and `mac` are learned from the light itself.
+    __slots__ = ('name', 'ipaddress', 'configured_ip', 'device_id', 'mac', 'type', 'device_type', 'account', 'light', 'mailbox',
+                 'state', 'desired', 'breaker', 'limiter', 'connection')
+
+    def __init__(self, name: str, ipaddress: str, device_type: DeviceType, account: str = DEFAULT_ACCOUNT) -> None:
+        self.name = name
+        self.ipaddress = ipaddress
+        self.configured_ip = ipaddress
+        self.device_id: Optional[str] = None
+        self.mac: Optional[str] = None
+        self.type = device_type.model
+        self.device_type = device_type
+        self.account = account  # name of the account in the config file whose credentials the light uses
+        self.light: Optional[Any] = None  # the tapo device handler once connected
+        self.mailbox = DeviceMailbox(name, device_type.color)
+        self.state = DeviceState()
+        self.desired = DesiredState()
+        self.breaker = DeviceBreaker(name)
+        self.limiter = DeviceRateLimiter(name, device_type.model)
+        self.connection = DeviceConnection(self)
+
+    def supports(self, action: str) -> bool:
+        return action in self.device_type.actions
+
+    def __repr__(self) -> str:
+        return f'Device({self.name!r}, {self.ipaddress!r}, {self.type!r})'
+
+class DeviceRegistry(Mapping):
+    # Devices by name in config order, indexed by IP address, type and supported action.
+    # A new registry is built on every config load, afterwards only `rebind` changes it.
+
+    def __init__(self, devices: Iterable[Device] = ()) -> None:
+        self._by_name: Dict[str, Device] = {}
+        self._by_ip: Dict[str, Device] = {}
+        self._by_type: Dict[str, List[Device]] = {}
+        self._by_action: Dict[str, List[str]] = {action: [] for action in DEVICE_ACTIONS}
+        for device in devices:
+            self._by_name[device.name] = device
+            self._by_ip[device.ipaddress] = device
+            self._by_type.setdefault(device.type, []).append(device)
+            for action in device.device_type.actions:
+                self._by_action[action].append(device.name)
+
+    def __getitem__(self, name: str) -> Device:
+        return self._by_name[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._by_name)
+
+    def __len__(self) -> int:
+        return len(self._by_name)
+
+    # Faster than the `Mapping` defaults, which go through `__getitem__`
+    def __contains__(self, name: object) -> bool:
+        return name in self._by_name
+
+    def get(self, name: str, default: Optional[Device] = None) -> Optional[Device]:
+        return self._by_name.get(name, default)
+
+    def values(self) -> Any:
+        return self._by_name.values()
+
+    def items(self) -> Any:
+        return self._by_name.items()
+
+    def by_ip(self, ipaddress: str) -> Optional[Device]:
+        return self._by_ip.get(ipaddress)
+
+    def by_type(self, model: str) -> List[Device]:
+        return self._by_type.get(model, [])
+
+    def rebind(self, device: Device, ipaddress: str) -> None:
+        # Moves a light found at another address by `DeviceDiscovery`
+        if self._by_ip.get(device.ipaddress) is device:
+            del self._by_ip[device.ipaddress]
+        device.ipaddress = ipaddress
+        self._by_ip[ipaddress] = device
+
+    def supporting(self, action: str) -> List[str]:
+        # Names of the devices supporting an action, in config order
+        return self._by_action.get(action, [])
+
+g_device_list = DeviceRegistry()
+g_group_list: Dict[str, List[str]] = {}
+g_group_actions: Dict[str, FrozenSet[str]] = {}  # actions at least one member of the group supports
+g_rate_limits: Dict[str, Dict[str, float]] = {}
+SceneEntry = Dict[str, int]
+ActionValues = Dict[str, Any]  # decoded action data by data name, see `ActionDecoder`
+g_scene_list: Dict[str, Dict[str, SceneEntry]] = {}
+g_scene_file: Optional[str] = None
+g_options: Dict[str, Any] = dict(DEFAULT_OPTIONS)
+g_tapo_initialized = False  # whether lights were connected since the plugin started
 
 # Plugin initialization
 
-@async_to_sync
+@run_on_tapo_loop
 async def handle_settings(settings, on_connect=False) -> None:
-    global g_device_list
-
     settings = {list(item)[0]: list(item.values())[0] for item in settings}
     config_file = settings.get(TP_PLUGIN_SETTINGS['configFile']['name']).strip()
     username = settings.get(TP_PLUGIN_SETTINGS['username']['name'])
     password = settings.get(TP_PLUGIN_SETTINGS['password']['name'])
 
+    changed_devices: List[str] = []
     if config_file and config_file:
         TP_PLUGIN_SETTINGS['configFile']['value'] = config_file
-        try:
-            device_list = read_config_file(config_file)
-            g_device_list = validate_devices(device_list)
-            update_choices()
-        except Exception as e:
-            g_log.warning(f'Failed to process config file: {e}')
+        changed_devices = load_config(config_file)
+        g_startup_timeline.mark('config loaded')
     if username:
         TP_PLUGIN_SETTINGS['username']['value'] = username
     if password:
         TP_PLUGIN_SETTINGS['password']['value'] = password
 
-    if username and password:
-        await initialize_tapo(username, password)
-
-async def initialize_tapo(username, password) -> None:
-    global g_tapo_client
-
-    g_tapo_client = ApiClient(username, password)
-    g_log.debug(f'initializeTapo: tapoClient is set with u> {username} & p> {password}')
+    if username and password and g_client_pool.set_default(username, password):
+        await initialize_tapo(username)
+    elif not g_tapo_initialized and g_client_pool.ready():
+        # No credentials in the settings, every account comes from the config file
+        await initialize_tapo('')
+    else:
+        # Same accounts: unchanged lights keep their sessions
+        connect_devices(changed_devices)
+
+    if not g_client_pool.ready():
+        if g_device_list:
+            g_log.warning('No Tapo credentials in the plugin settings or the config file, lights will not connect')
+    elif not g_client_pool.ready(DEFAULT_ACCOUNT):
+        if unset := sum(1 for device in g_device_list.values() if device.account == DEFAULT_ACCOUNT):
+            g_log.warning(f'{unset} lights have no account and the plugin settings have no credentials, they will not connect')
+
+def load_config(config_file: str) -> List[str]:
+    # Applies the config file on top of the current one. Lights whose name, IP, type and
+    # account credentials are unchanged keep their connection, state and pending commands.
+    # Returns the names of added or modified lights, which still need a handshake.
+    global g_device_list, g_group_list, g_group_actions, g_rate_limits, g_scene_list, g_scene_file, g_options
 
-    tasks = [fetch_device(g_tapo_client, device) for device in g_device_list.values()]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    try:
+        config = read_config_file(config_file)
+        if config is None:
+            # Keep the current config rather than dropping every light
+            return []
+        g_options = config['options']
+        changed_rate_limits = {model for model in g_rate_limits.keys() | config['rate_limits'].keys()
+                               if g_rate_limits.get(model) != config['rate_limits'].get(model)}
+        g_rate_limits = config['rate_limits']
+        if g_options['metrics_file']:
+            g_options['metrics_file'] = os.path.join(os.path.dirname(config_file), g_options['metrics_file'])
+
+        # Known addresses of moved lights are needed before the new devices are created
+        g_discovery.load(os.path.join(os.path.dirname(config_file), DISCOVERY_FILE_NAME))
+        changed_accounts = g_client_pool.configure(config['accounts'])
+        devices: List[Device] = []
+        changed_devices: List[str] = []
+        for name, (ipaddress, device_type, account) in config['devices'].items():
+            current = g_device_list.get(name)
+            if (current and current.configured_ip == ipaddress and current.device_type is device_type
+                    and current.account == account and account not in changed_accounts):
+                devices.append(current)
+            else:
+                device = Device(name, ipaddress, device_type, account)
+                g_discovery.apply(device)
+                devices.append(device)
+                changed_devices.append(name)
+        registry = DeviceRegistry(devices)
+        # Removed and modified lights drop their old connection
+        for name, device in g_device_list.items():
+            if registry.get(name) is not device:
+                device.connection.close()
+        removed_devices = [name for name in g_device_list if name not in registry]
+        if g_device_list:
+            g_log.info(f'Config reloaded: {len(changed_devices)} lights added or changed, {len(removed_devices)} removed')
+
+        g_device_list = registry
+        # Kept lights of a type whose limits changed start over from the new limits
+        for model in changed_rate_limits:
+            for device in registry.by_type(model):
+                device.limiter.reset()
+        g_group_list = validate_groups(config['groups'], g_device_list)
+        g_group_actions = {name: frozenset(action for member in members for action in g_device_list[member].device_type.actions)
+                           for name, members in g_group_list.items()}
+        with timed('update_choices'):
+            update_choices()
+        remove_stale_device_states()
+        g_scene_file = os.path.join(os.path.dirname(config_file), SCENE_FILE_NAME)
+        g_startup_cache.file_path = os.path.join(os.path.dirname(config_file), STARTUP_CACHE_FILE_NAME)
+        g_scene_list = read_scene_file(g_scene_file)
+        update_scene_choices()
+        return changed_devices
+    except Exception as e:
+        g_log.warning(f'Failed to process config file: {e}')
+        return []
+    finally:
+        # Re-armed on every load, so a reload turning `config_watch_interval` back on takes effect
+        g_config_watcher.watch(config_file)
 
-    for device, result in zip(g_device_list.values(), results):
-        if isinstance(result, Exception):
-            device['light'] = None
+def connect_devices(device_names: List[str]) -> None:
+    # Must be called on the Tapo event loop
+    if not g_client_pool.ready():
+        return
+    for name in device_names:
+        g_device_list[name].connection.restart()
+    start_background_tasks()
+
+def start_background_tasks() -> None:
+    # Must be called on the Tapo event loop, tasks already running are left alone
+    g_poller.start()
+    g_session_keeper.start()
+    g_reconciler.start()
+    g_metrics_reporter.start()
+
+def preload_modules() -> None:
+    # Runs first on the Tapo loop, so the settings handler finds these modules loaded
+    for name in DEFERRED_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            g_log.warning(f'Error preloading {name}: {repr(e)}')
+    g_startup_timeline.mark('modules preloaded')
+
+async def initialize_tapo(username: str) -> None:
+    # The settings account changed: its lights connect again with the new credentials,
+    # lights of other accounts keep their sessions. `username` is empty when the
+    # settings have no credentials and every account comes from the config file.
+    global g_tapo_initialized
+
+    g_tapo_initialized = True
+    g_client_pool.client(DEFAULT_ACCOUNT)
+    g_log.debug(f'initializeTapo: tapoClient is set with u> {username or "config file accounts"}')
+    g_startup_timeline.mark('tapo client ready')
+
+    # Show the last known state right away, handshakes run in the background so
+    # startup doesn't wait for the slowest light
+    g_startup_cache.load(username)
+    g_startup_timeline.mark('cached states shown')
+    # With `max_connections` the remaining lights connect on their first action
+    limit = g_options['max_connections']
+    for index, device in enumerate(device for device in g_device_list.values() if device.account == DEFAULT_ACCOUNT or not device.light):
+        if limit <= 0 or index < limit:
+            device.connection.restart()
         else:
-            device['light'] = result
+            device.connection.release()
+    start_background_tasks()
 
-async def fetch_device(client: ApiClient, device: Device) -> Optional[Any]:
+async def fetch_device(client: 'ApiClient', device: Device) -> Optional[Any]:
     try:
-        g_log.debug(f'trying fetch_device: d> {device['name']} & ip> {device['ipaddress']}')
-        light: Any
-        
-        # Select API method based on device type
-        if device['type'] == 'L510':
-            light = await client.l510(device['ipaddress'])
-        elif device['type'] == 'L520':
-            light = await client.l520(device['ipaddress'])
-        elif device['type'] == 'L610':
-            light = await client.l610(device['ipaddress'])
-        elif device['type'] == 'L530':
-            light = await client.l530(device['ipaddress'])
-        elif device['type'] == 'L630':
-            light = await client.l630(device['ipaddress'])
-        else:
-            g_log.warning(f'Unsupported device type: {device['type']} for device {device['ipaddress']}')
-            return None
+        g_log.debug(f'trying fetch_device: d> {device.name} & ip> {device.ipaddress}')
 
-        g_log.debug(f'fetch_device: d> {device['name']} & ip> {device['ipaddress']} OK!')
+        # The API method creating the handler comes from the device type table
+        light = await getattr(client, device.device_type.factory)(device.ipaddress)
+
+        g_log.debug(f'fetch_device: d> {device.name} & ip> {device.ipaddress} OK!')
         return light
     except Exception as e:
-        g_log.warning(f'Error fetching data for {device['name']}: {e}')
+        g_log.warning(f'Error fetching data for {device.name}: {e}')
         return None
 
-def read_config_file(file_path) -> Dict[str, Device]:
-    file_devices: Dict[str, Device] = {}
+def read_config_file(file_path) -> Optional[Dict[str, Any]]:
+    import yaml
+
+    file_devices: Dict[str, Tuple[str, DeviceType, str]] = {}  # name -> IP address, type and account
+    file_options: Dict[str, Any] = dict(DEFAULT_OPTIONS)
+    file_groups: Dict[str, List[str]] = {}
+    file_rate_limits: Dict[str, Dict[str, float]] = {}
+    file_accounts: Dict[str, Tuple[str, str]] = {}
+    device_accounts: Dict[str, str] = {}  # name -> account set on the device itself
+    state_names: Dict[str, str] = {}  # state ID part -> light or group name using it, see `state_id_name`
 
     try:
         with open(file_path, 'r') as file:
-            data = yaml.safe_load(file)
+            data = yaml.safe_load(file) or {}
             for device_type, devices in data.items():
+                if device_type in CONFIG_SECTIONS:
+                    continue
+                if device_type not in DEVICE_TYPES:
+                    g_log.warning(f'Unsupported device type: t> {device_type}')
+                    continue
                 if devices:
                     for device in devices:
                         if 'name' in device and 'ip' in device:
-                            file_devices[device['name']] = {
-                                'name': device['name'],
-                                'ipaddress': device['ip'],
-                                'type': device_type,
-                                'light': None, # it will contain reference to tapo light
-                            }
+                            if not claim_state_name(state_names, device['name']):
+                                continue
+                            file_devices[device['name']] = (device['ip'], DEVICE_TYPES[device_type], DEFAULT_ACCOUNT)
+                            if device.get('account'):
+                                device_accounts[device['name']] = str(device['account'])
                         else:
                             g_log.warning(f'Device is missing "name" or "ip": t> {device_type} d> {device}')
-            g_log.debug(f'Config file: {file_path} read: dl> {devices}')
+            file_options.update(read_config_options(data.get('options')))
+            for group_name, members in (data.get('groups') or {}).items():
+                if not claim_state_name(state_names, group_name):
+                    continue
+                if isinstance(members, list):
+                    file_groups[str(group_name)] = [str(member) for member in members]
+                else:
+                    g_log.warning(f'Group is not a list of light names: g> {group_name}')
+            file_rate_limits = read_config_rate_limits(data.get('rate_limits'), file_options)
+            file_accounts, group_accounts = read_config_accounts(data.get('accounts'))
+            # An account set on the light wins over the account of its group
+            for group_name, account in group_accounts.items():
+                if group_name not in file_groups:
+                    g_log.warning(f'Unknown group of account: a> {account} g> {group_name}')
+                for member in file_groups.get(group_name, []):
+                    device_accounts.setdefault(member, account)
+            for name, account in device_accounts.items():
+                if name not in file_devices:
+                    continue
+                if account not in file_accounts:
+                    g_log.warning(f'Unknown account: d> {name} a> {account}')
+                    continue
+                file_devices[name] = file_devices[name][:2] + (account,)
+            # Credentials are left out of the log
+            g_log.debug(f'Config file: {file_path} read: dl> {file_devices} g> {file_groups} o> {file_options} r> {file_rate_limits} '
+                        f'a> {list(file_accounts)}')
     except Exception as e:
         g_log.warning(f'Error reading file {file_path}: {repr(e)}')
-        return {}
-    
-    return file_devices
+        return None
+
+    return {'devices': file_devices, 'groups': file_groups, 'options': file_options, 'rate_limits': file_rate_limits,
+            'accounts': file_accounts}
 
-def validate_devices(devices: Dict[str, Device]) -> Dict[str, Device]:
-    validated_devices: Dict[str, Device] = {}
+def claim_state_name(state_names: Dict[str, str], name: Any) -> bool:
+    # Names differing only in punctuation or spaces would share their states, the later one is dropped
+    if (taken := state_names.setdefault(state_id_name(str(name)), str(name))) != str(name):
+        g_log.warning(f'Name has the same state IDs as "{taken}", skipped: n> {name}')
+        return False
+    return True
 
-    for name, device in devices.items():
-        if device['type'] not in SUPPORTED_DEVICE_TYPES:
-            g_log.warning(f'Unsupported device type: t> {device['type']} d> {name}')
+def read_config_options(options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    valid_options: Dict[str, Any] = {}
+
+    for key, value in (options or {}).items():
+        if key not in DEFAULT_OPTIONS:
+            g_log.warning(f'Unknown option: o> {key}')
+            continue
+        try:
+            valid_value = type(DEFAULT_OPTIONS[key])(value)
+        except (TypeError, ValueError):
+            g_log.warning(f'Invalid value for option: o> {key} v> {value}')
+            continue
+        # No option takes a negative number, intervals too short for their loop are raised where they are read
+        if isinstance(valid_value, (int, float)) and valid_value < 0:
+            g_log.warning(f'Negative value for option, using the default: o> {key} v> {value}')
+            continue
+        if key in RATE_LIMIT_OPTIONS and not valid_rate_limit(key, valid_value):
+            g_log.warning(f'Invalid value for rate limit option, using the default: o> {key} v> {value}')
+            continue
+        valid_options[key] = valid_value
+
+    if not rate_limits_ordered({**DEFAULT_OPTIONS, **valid_options}):
+        g_log.warning('Option rate_limit_min is above rate_limit_max, using the defaults of both')
+        valid_options.pop('rate_limit_min', None)
+        valid_options.pop('rate_limit_max', None)
+
+    return valid_options
+
+def valid_rate_limit(option: str, value: float) -> bool:
+    # Rates and the latency must be above 0, a burst must let at least one request through
+    return value >= 1 if option == 'rate_limit_burst' else value > 0
+
+def rate_limits_ordered(limits: Dict[str, Any]) -> bool:
+    return limits['rate_limit_min'] <= limits['rate_limit_max']
+
+def read_config_rate_limits(rate_limits: Optional[Dict[str, Any]], options: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    # Invalid limits fall back to the `rate_limit_*` options, which are already checked
+    valid_rate_limits: Dict[str, Dict[str, float]] = {}
+
+    for device_type, limits in (rate_limits or {}).items():
+        if device_type not in DEVICE_TYPES or not isinstance(limits, dict):
+            g_log.warning(f'Invalid rate limits: t> {device_type}')
+            continue
+        valid_rate_limits[device_type] = {}
+        for key, value in limits.items():
+            if key not in RATE_LIMIT_KEYS:
+                g_log.warning(f'Unknown rate limit: t> {device_type} k> {key}')
+                continue
+            try:
+                valid_value = float(value)
+            except (TypeError, ValueError):
+                g_log.warning(f'Invalid value for rate limit: t> {device_type} k> {key} v> {value}')
+                continue
+            if not valid_rate_limit(RATE_LIMIT_KEYS[key], valid_value):
+                g_log.warning(f'Invalid value for rate limit, using the option: t> {device_type} k> {key} v> {value}')
+                continue
+            valid_rate_limits[device_type][RATE_LIMIT_KEYS[key]] = valid_value
+        limits = valid_rate_limits[device_type]
+        if not rate_limits_ordered({**options, **limits}):
+            g_log.warning(f'Rate limit min_rate is above max_rate, using the options for both: t> {device_type}')
+            limits.pop('rate_limit_min', None)
+            limits.pop('rate_limit_max', None)
+
+    return valid_rate_limits
+
+def read_config_accounts(accounts: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Tuple[str, str]], Dict[str, str]]:
+    # Returns the credentials by account name, and the account of every group listed by one
+    valid_accounts: Dict[str, Tuple[str, str]] = {}
+    group_accounts: Dict[str, str] = {}
+
+    for name, account in (accounts or {}).items():
+        name = str(name)
+        if not isinstance(account, dict) or not account.get('username') or not account.get('password'):
+            g_log.warning(f'Account is missing "username" or "password": a> {name}')
+            continue
+        valid_accounts[name] = (str(account['username']), str(account['password']))
+        for group_name in account.get('groups') or []:
+            if str(group_name) in group_accounts:
+                g_log.warning(f'Group already has an account: g> {group_name} a> {group_accounts[str(group_name)]}')
+                continue
+            group_accounts[str(group_name)] = name
+
+    return valid_accounts, group_accounts
+
+def validate_groups(groups: Dict[str, List[str]], devices: DeviceRegistry) -> Dict[str, List[str]]:
+    validated_groups: Dict[str, List[str]] = {}
+
+    for name, members in groups.items():
+        if name in devices:
+            g_log.warning(f'Group name is already used by a device: g> {name}')
+            continue
+        for member in members:
+            if member not in devices:
+                g_log.warning(f'Unknown group member: g> {name} d> {member}')
+        # Keep config order but drop unknown and repeated members
+        valid_members = list(dict.fromkeys(member for member in members if member in devices))
+        if valid_members:
+            validated_groups[name] = valid_members
         else:
-            validated_devices[name] = device
-    
-    g_log.debug(f'Device list validated: gdl> {validated_devices}')
-    return validated_devices
+            g_log.warning(f'Group has no valid members: g> {name}')
+
+    g_log.debug(f'Group list validated: ggl> {validated_groups}')
+    return validated_groups
+
+def action_choices(action: str) -> List[str]:
+    # Devices supporting the action, then groups where at least one member supports it
+    if action not in GROUP_ACTIONS:
+        return g_device_list.supporting(action)
+    return g_device_list.supporting(action) + [name for name, actions in g_group_actions.items() if action in actions]
 
 def update_choices() -> None:
-    global g_device_list
+    for choice_id, action in DEVICE_LIST_CHOICES:
+        publish_choices(choice_id, action_choices(action))
+
+g_published_choices: Dict[str, List[str]] = {}
+
+def publish_choices(choice_id: str, values: List[str]) -> None:
+    # Only sends a choice list to TP when it differs from the last one sent
+    if g_published_choices.get(choice_id, []) == values:
+        return
+    TPClient.choiceUpdate(choice_id, values)
+    g_published_choices[choice_id] = values
+
+# Scenes
+
+def read_scene_file(file_path: str) -> Dict[str, Dict[str, SceneEntry]]:
+    if not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path, 'r') as file:
+            scenes = json.load(file)
+            g_log.debug(f'Scene file: {file_path} read: s> {list(scenes)}')
+            return scenes
+    except Exception as e:
+        g_log.warning(f'Error reading scene file {file_path}: {repr(e)}')
+        return {}
+
+def write_scene_file(file_path: str, scenes: Dict[str, Dict[str, SceneEntry]]) -> None:
+    # Written to a temporary file first so a crash never leaves a truncated store behind
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(scenes, file, separators=(',', ':'))
+    os.replace(temp_path, file_path)
+
+def update_scene_choices() -> None:
+    publish_choices(TP_PLUGIN_ACTIONS['RecallScene']['data']['scene']['id'], sorted(g_scene_list))
+
+def scene_entry(state: 'DeviceState') -> SceneEntry:
+    # Compact form of a device state, only known values are stored
+    entry: SceneEntry = {'on': int(bool(state.device_on))}
+    for key, value in (('bright', state.brightness), ('hue', state.hue), ('sat', state.saturation), ('temp', state.color_temp)):
+        if value is not None:
+            entry[key] = value
+    return entry
+
+@run_on_tapo_loop
+async def save_scene(scene_name: str) -> None:
+    global g_scene_list
+
+    limit = asyncio.Semaphore(max(1, g_options['group_concurrency']))
+
+    async def capture(device: Device) -> Optional[SceneEntry]:
+        async with limit:
+            try:
+                if device.breaker.allow_request() and await device.connection.get_light():
+                    async with g_request_scheduler.slot(device.name, PRIORITY_SET):
+                        await refresh_device_state(device)
+            except Exception as e:
+                g_log.debug(f'Scene: {scene_name} | d> {device.name} read failed: {repr(e)}')
+        # Fall back to the last known state of a light that could not be read
+        return scene_entry(device.state) if device.state.device_on is not None else None
+
+    devices = list(g_device_list.values())
+    entries = await asyncio.gather(*(capture(device) for device in devices))
+    scene = {device.name: entry for device, entry in zip(devices, entries) if entry is not None}
+    missing = [device.name for device, entry in zip(devices, entries) if entry is None]
+    if missing:
+        g_log.warning(f'Scene: {scene_name} | state unknown for: {missing}')
+
+    g_scene_list = {**g_scene_list, scene_name: scene}
+    if g_scene_file:
+        write_scene_file(g_scene_file, g_scene_list)
+    update_scene_choices()
+    g_log.info(f'Scene: {scene_name} saved with {len(scene)} lights')
+
+@run_on_tapo_loop
+async def recall_scene(scene_name: str, aid: str, values: ActionValues) -> None:
+    if not (scene := g_scene_list.get(scene_name)):
+        g_log.debug(f'Scene: {scene_name} not found!')
+        return
+
+    failed = await fan_out_command([name for name in scene if name in g_device_list], aid, 'RecallScene', values)
+    if failed:
+        g_log.warning(f'Scene: {scene_name} | recall failed for: {failed}')
+
+# Startup timeline
+
+class StartupTimeline:
+    # Milliseconds from the start of the plugin module to each startup phase, logged so
+    # startup changes can be checked on the frozen binary. Phases reached before logging
+    # is set up are logged by `start_logging`. Only the first time a phase is reached
+    # counts, so config reloads and reconnects don't move it.
+
+    def __init__(self, began: float) -> None:
+        self.began = began
+        self.phases: Dict[str, float] = {}
+        self._logging = False
+
+    def mark(self, phase: str, at: Optional[float] = None) -> None:
+        if phase in self.phases:
+            return
+        self.phases[phase] = ((time.perf_counter() if at is None else at) - self.began) * 1000
+        if self._logging:
+            self._log(phase)
+
+    def on_connected(self) -> None:
+        # The first connected light is the first one actions can reach without waiting
+        if 'all lights ready' in self.phases:
+            return
+        self.mark('first light ready')
+        if all(device.light for device in g_device_list.values()):
+            self.mark('all lights ready')
+
+    def start_logging(self) -> None:
+        self._logging = True
+        for phase in self.phases:
+            self._log(phase)
+
+    def _log(self, phase: str) -> None:
+        g_log.info(f'Startup: {phase} after {self.phases[phase]:.1f}ms')
+
+g_startup_timeline = StartupTimeline(STARTUP_BEGAN)
+g_startup_timeline.mark('imports', STARTUP_IMPORTED)
+
+# Startup cache
+
+class StartupCache:
+    # Last known state of every light, keyed by configured IP address and account, so the deck shows
+    # it right after a restart while the handshakes are still running. `tapo` doesn't
+    # expose session keys, so sessions themselves can't be reused. Only a hash of the
+    # username is stored, never credentials. Must only be used on the Tapo event loop.
+
+    def __init__(self) -> None:
+        self.file_path: Optional[str] = None
+        self._account = ''
+        self._loaded_at = 0.0
+        self._saved_at = 0.0
+        self._waiting: Dict[str, float] = {}  # device name -> when its cached state was shown
+        self._saved_seconds: List[float] = []
+
+    def load(self, username: str) -> None:
+        self._account = hashlib.sha256(username.encode()).hexdigest()[:16]
+        self._loaded_at = time.monotonic()
+        self._waiting.clear()
+        self._saved_seconds.clear()
+        if not self.file_path or g_options['startup_cache_ttl'] <= 0 or not os.path.exists(self.file_path):
+            return
+
+        try:
+            with open(self.file_path, 'r') as file:
+                cache = json.load(file)
+        except Exception as e:
+            g_log.warning(f'Error reading startup cache {self.file_path}: {repr(e)}')
+            return
+        if cache.get('account') != self._account:
+            return
+
+        entries = cache.get('devices', {})
+        for device in g_device_list.values():
+            entry = entries.get(device.configured_ip)
+            if not entry or entry.get('type') != device.type or time.time() - entry.get('saved_at', 0) > g_options['startup_cache_ttl']:
+                continue
+            # Shown but not trusted: `refreshed_at` stays 0 so Toggle still reads the light
+            state: DeviceState = device.state
+            state.device_on = bool(entry['on'])
+            state.brightness = entry.get('bright')
+            state.hue, state.saturation, state.color_temp = entry.get('hue'), entry.get('sat'), entry.get('temp')
+            publish_device_states(device, reachable=False)
+            self._waiting[device.name] = time.monotonic()
+        g_log.debug(f'Startup cache: {len(self._waiting)} light states shown from {self.file_path}')
+
+    def on_connected(self, device: Device) -> None:
+        if (shown_at := self._waiting.pop(device.name, None)) is None:
+            return
+        self._saved_seconds.append(time.monotonic() - shown_at)
+        if not self._waiting:
+            g_log.info(f'Startup cache: {len(self._saved_seconds)} light states were shown {sum(self._saved_seconds) / len(self._saved_seconds):.2f}s '
+                       f'on average (max {max(self._saved_seconds):.2f}s) before their handshakes finished')
+
+    def save_if_due(self) -> None:
+        if time.monotonic() - self._saved_at >= STARTUP_CACHE_SAVE_INTERVAL:
+            self.save()
+
+    def save(self) -> None:
+        self._saved_at = time.monotonic()
+        if not self.file_path or not self._account or g_options['startup_cache_ttl'] <= 0:
+            return
+
+        now = time.time()
+        devices = {
+            device.configured_ip: {'type': device.type, 'saved_at': int(now), **scene_entry(device.state)}
+            for device in g_device_list.values() if device.state.device_on is not None
+        }
+        try:
+            # Readable by the current user only
+            temp_path = self.file_path + '.tmp'
+            with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+                json.dump({'account': self._account, 'devices': devices}, file, separators=(',', ':'))
+            os.replace(temp_path, self.file_path)
+        except Exception as e:
+            g_log.warning(f'Error writing startup cache {self.file_path}: {repr(e)}')
+
+g_startup_cache = StartupCache()
+
+# Tapo accounts
+
+def account_label(account: str) -> str:
+    return account or 'default'
+
+class ClientPool:
+    # One `ApiClient` per set of credentials, shared by the lights of every account using
+    # them, and the limit on open light connections. `tapo` keeps one HTTP connection per
+    # light handler and closes it when the handler is dropped, so `max_connections` is kept
+    # by dropping the handlers of the least recently used idle lights. Must only be used
+    # on the Tapo event loop.
+
+    def __init__(self) -> None:
+        self._credentials: Dict[str, Tuple[str, str]] = {}  # account name -> username and password
+        self._clients: Dict[Tuple[str, str], 'ApiClient'] = {}
+        self._baseline_memory: Optional[int] = None  # process memory before the first client was created
+
+    def ready(self, account: Optional[str] = None) -> bool:
+        # Whether `account` has credentials, from the plugin settings or the config file.
+        # Without an account, whether any has: lights connect once their own account does.
+        if account is None:
+            return bool(self._credentials)
+        return account in self._credentials
+
+    def configure(self, accounts: Dict[str, Tuple[str, str]]) -> Set[str]:
+        # Applies the accounts of the config file, returns the accounts whose credentials changed
+        if self.ready(DEFAULT_ACCOUNT):
+            accounts = {DEFAULT_ACCOUNT: self._credentials[DEFAULT_ACCOUNT], **accounts}
+        changed = {name for name in self._credentials.keys() | accounts.keys() if self._credentials.get(name) != accounts.get(name)}
+        self._credentials = accounts
+        self._prune()
+        return changed
+
+    def set_default(self, username: str, password: str) -> bool:
+        # Applies the credentials of the plugin settings, returns whether they changed
+        if self._credentials.get(DEFAULT_ACCOUNT) == (username, password):
+            return False
+        self._credentials[DEFAULT_ACCOUNT] = (username, password)
+        self._prune()
+        return True
+
+    def client(self, account: str) -> Optional['ApiClient']:
+        if (credentials := self._credentials.get(account)) is None:
+            return None
+        if (client := self._clients.get(credentials)) is None:
+            from tapo import ApiClient
+
+            if self._baseline_memory is None:
+                self._baseline_memory = process_memory()
+            client = self._clients[credentials] = ApiClient(*credentials)
+        return client
+
+    def _prune(self) -> None:
+        # Clients of credentials no longer used are dropped, their lights reconnect
+        used = set(self._credentials.values())
+        for credentials in [credentials for credentials in self._clients if credentials not in used]:
+            del self._clients[credentials]
+
+    def make_room(self, device: Device) -> None:
+        # Called before `device` gets its handler
+        limit = g_options['max_connections']
+        if limit <= 0:
+            return
+        connected = [other for other in g_device_list.values() if other.light and other is not device]
+        if (excess := len(connected) + 1 - limit) <= 0:
+            return
+        # Lights with pending commands or a running effect keep their connection, so the
+        # limit may be exceeded for a moment rather than delaying an action
+        idle = [other for other in connected if not len(other.mailbox) and not g_effect_scheduler.is_running(other.name)]
+        for other in sorted(idle, key=lambda other: other.connection.used_at)[:excess]:
+            g_log.debug(f'Connection: d> {other.name} disconnected to stay within {limit} connections')
+            other.connection.release()
+            g_metrics.connections_released += 1
+
+    def report(self) -> Dict[str, Dict[str, int]]:
+        # Lights, open connections and estimated memory per account. The memory is what the
+        # process grew by since the first client was created, shared out by open connections.
+        report = {account_label(name): {'lights': 0, 'connections': 0, 'memory_bytes': 0} for name in self._credentials}
+        for device in g_device_list.values():
+            if (entry := report.get(account_label(device.account))) is not None:
+                entry['lights'] += 1
+                entry['connections'] += 1 if device.light else 0
+        connections = sum(entry['connections'] for entry in report.values())
+        memory = process_memory()
+        if connections and memory is not None and self._baseline_memory is not None:
+            grown = max(0, memory - self._baseline_memory)
+            for entry in report.values():
+                entry['memory_bytes'] = grown * entry['connections'] // connections
+        return report
+
+g_client_pool = ClientPool()
+
+def process_memory() -> Optional[int]:
+    # Resident memory of the plugin process in bytes, None where it can't be read
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            from ctypes import wintypes
+
+            class ProcessMemoryCounters(ctypes.Structure):
+                _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+                    (name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                                                         'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+
+            counters = ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            process = ctypes.windll.kernel32.GetCurrentProcess()
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+                return None
+            return counters.WorkingSetSize
+        if os.path.exists('/proc/self/statm'):
+            with open('/proc/self/statm', 'r') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        # macOS: only the peak is available without extra packages
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except Exception as e:
+        g_log.debug(f'Error reading process memory: {repr(e)}')
+        return None
 
-    all_actions = {action for actions in SUPPORTED_DEVICE_TYPES.values() for action in actions}
-    filtered_choices = {action: [] for action in all_actions}
+# Request scheduling
+
+# Priority classes of the requests sent to lights, lower goes first
+PRIORITY_POWER = 0  # user On / Off and Toggle
+PRIORITY_SET = 1  # other user actions, sliders and scenes
+PRIORITY_EFFECT = 2  # effect frames
+PRIORITY_BACKGROUND = 3  # polls, session refreshes and reads after a handshake
+PRIORITY_NAMES = ('power', 'set', 'effect', 'background')
+
+POWER_ACTIONS = {'On_Off', 'Toggle'}
+
+class PriorityGate:
+    # Lets up to `capacity()` holders in at a time. Waiters are let in by priority
+    # class, then in order of arrival. Must only be used on the Tapo event loop.
+
+    def __init__(self, capacity: Callable[[], int]) -> None:
+        self.capacity = capacity
+        self.in_use = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._arrivals = 0
+
+    def idle(self) -> bool:
+        return self.in_use == 0 and not self._waiters
+
+    async def acquire(self, priority: int) -> None:
+        if self.in_use < self.capacity() and not self._waiters:
+            self.in_use += 1
+            return
+        self._arrivals += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._arrivals, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Let in right before being cancelled, pass the place on
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_use -= 1
+        while self._waiters and self.in_use < self.capacity():
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.in_use += 1
+                future.set_result(None)
+
+class RequestScheduler:
+    # Admits every request sent over a light's session. A light has one request in
+    # flight at a time, different lights run in parallel up to `request_concurrency`,
+    # and waiting requests are let in by priority class so a user's tap never waits
+    # behind a poll or an effect frame. Handshakes don't use a session and aren't
+    # scheduled here. Must only be used on the Tapo event loop.
+
+    def __init__(self) -> None:
+        self.waiting = [0] * len(PRIORITY_NAMES)
+        self._global = PriorityGate(lambda: max(1, g_options['request_concurrency']))
+        self._devices: Dict[str, PriorityGate] = {}
+
+    @asynccontextmanager
+    async def slot(self, device_name: str, priority: int) -> Any:
+        if (gate := self._devices.get(device_name)) is None:
+            gate = self._devices[device_name] = PriorityGate(lambda: 1)
+        device = g_device_list.get(device_name)
+        limiter: Optional[DeviceRateLimiter] = device.limiter if device else None
+        started = time.perf_counter()
+        self.waiting[priority] += 1
+        try:
+            await gate.acquire(priority)
+            try:
+                # Waiting for the light's rate limit doesn't hold up other lights
+                if limiter is not None:
+                    await limiter.acquire()
+                await self._global.acquire(priority)
+            except BaseException:
+                gate.release()
+                raise
+        finally:
+            self.waiting[priority] -= 1
+        g_metrics.observe('priority_wait', time.perf_counter() - started, PRIORITY_NAMES[priority])
+
+        sent_at = time.perf_counter()
+        try:
+            yield
+            if limiter is not None:
+                limiter.record_success(time.perf_counter() - sent_at)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if limiter is not None:
+                limiter.record_failure()
+            raise
+        finally:
+            self._global.release()
+            gate.release()
+            if gate.idle() and self._devices.get(device_name) is gate:
+                del self._devices[device_name]
+
+g_request_scheduler = RequestScheduler()
+
+def command_priority(command: 'DeviceCommand') -> int:
+    if command.action in POWER_ACTIONS:
+        return PRIORITY_POWER
+    if command.action == EFFECT_FRAME_ACTION:
+        return PRIORITY_EFFECT
+    return PRIORITY_SET
+
+# Device connections
+
+class DeviceConnection:
+    # Owns the Tapo handshake of a device. Connects lazily on first use (or when warmed
+    # up by `restart`) and retries failed handshakes with jittered exponential backoff.
+    # Must only be used on the Tapo event loop.
+
+    def __init__(self, device: Device) -> None:
+        self.device = device
+        self.failures = 0
+        self.session_started_at = 0.0
+        self.refresh_at = 0.0
+        self.used_at = 0.0  # last time an action needed the light, see `ClientPool.make_room`
+        self._connecting: Optional[asyncio.Task] = None
+        self._retry: Optional[asyncio.TimerHandle] = None
+        self._closed = False
+
+    @property
+    def light(self) -> Optional[Any]:
+        return self.device.light
+
+    async def get_light(self, wait: Optional[float] = None) -> Optional[Any]:
+        # Returns the light handler, waiting briefly for a handshake in progress
+        self.used_at = time.monotonic()
+        if self.light or self._closed:
+            return self.light
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.connect()), g_options['connect_wait'] if wait is None else wait)
+        except asyncio.TimeoutError:
+            g_log.debug(f'Connection: d> {self.device.name} still connecting')
+            return None
 
-    # Populate the filtered choices based on device capabilities
-    for name, device in g_device_list.items():
-        for action in SUPPORTED_DEVICE_TYPES[device['type']]:
-            filtered_choices[action].append(name)
+    def connect(self) -> asyncio.Task:
+        # Starts a handshake unless one is already in progress
+        if self._connecting is None or self._connecting.done():
+            self._cancel_retry()
+            self._connecting = asyncio.get_running_loop().create_task(self._connect())
+        return self._connecting
+
+    def restart(self) -> None:
+        # Drops the current handler and warms up a new connection in the background
+        self._cancel()
+        self.device.light = None
+        self.device.breaker.reset()
+        self.failures = 0
+        self.connect()
+
+    def reset(self) -> None:
+        # Called after a failed request, reconnects once the backoff allows it
+        if self._closed or not self.light:
+            return
+        self.device.light = None
+        self._schedule_retry()
+
+    def release(self) -> None:
+        # Drops the handler of an idle light, which closes its connection. The next
+        # action connects again.
+        self._cancel()
+        self.device.light = None
+
+    def close(self) -> None:
+        self._closed = True
+        self._cancel()
+
+    def refresh_due(self) -> bool:
+        return bool(self.light) and g_options['session_refresh_age'] > 0 and time.monotonic() >= self.refresh_at
+
+    async def refresh(self) -> None:
+        # Renews the session of a connected light before the light expires it, so the
+        # next action doesn't pay for a failed request plus a handshake
+        light = self.light
+        if not light or self._closed:
+            return
+        age = time.monotonic() - self.session_started_at
+        try:
+            async with g_request_scheduler.slot(self.device.name, PRIORITY_BACKGROUND):
+                with timed('session_refresh', device=self.device.name):
+                    await asyncio.wait_for(light.refresh_session(), g_options['connect_timeout'])
+        except Exception as e:
+            g_metrics.session_refresh_failures += 1
+            g_log.debug(f'Connection: d> {self.device.name} session refresh failed: {repr(e)}')
+            self.reset()
+            return
+        g_metrics.session_refreshes += 1
+        g_log.debug(f'Connection: d> {self.device.name} session refreshed after {age:.0f}s')
+        self._session_started()
+
+    def _session_started(self) -> None:
+        # Refreshes are spread over the last 15% of the session age, so lights that
+        # connected together don't all refresh at the same time
+        self.session_started_at = time.monotonic()
+        self.refresh_at = self.session_started_at + g_options['session_refresh_age'] * random.uniform(0.85, 1.0)
+
+    async def _connect(self) -> Optional[Any]:
+        if (client := g_client_pool.client(self.device.account)) is None:
+            return None
 
-    TPClient.choiceUpdate(TP_PLUGIN_ACTIONS['On_Off']['data']['device_list']['id'], filtered_choices['On_Off'])
-    TPClient.choiceUpdate(TP_PLUGIN_ACTIONS['Toggle']['data']['device_list']['id'], filtered_choices['Toggle'])
-    TPClient.choiceUpdate(TP_PLUGIN_ACTIONS['Bright']['data']['device_list']['id'], filtered_choices['Bright'])
+        breaker: DeviceBreaker = self.device.breaker
+        breaker.begin_probe()
+        try:
+            with timed('handshake', device=self.device.name):
+                light = await asyncio.wait_for(fetch_device(client, self.device), g_options['connect_timeout'])
+        except asyncio.TimeoutError:
+            g_log.warning(f'Connection: d> {self.device.name} handshake timed out')
+            light = None
+        if self._closed:
+            return None
+        if not light:
+            self.failures += 1
+            breaker.record_failure()
+            publish_device_states(self.device, reachable=False)
+            self._schedule_retry()
+            if self.failures >= DISCOVERY_FAILURES:
+                # The light may have got a new address from DHCP
+                g_discovery.request()
+            return None
 
-    if any(filtered_choices['RGB']):
-        TPClient.choiceUpdate(TP_PLUGIN_ACTIONS['RGB']['data']['device_list']['id'], filtered_choices['RGB'])
+        self.failures = 0
+        g_client_pool.make_room(self.device)
+        self.device.light = light
+        self._session_started()
+        breaker.record_success()
+        g_startup_cache.on_connected(self.device)
+        g_startup_timeline.on_connected()
+        try:
+            async with g_request_scheduler.slot(self.device.name, PRIORITY_BACKGROUND):
+                await refresh_device_state(self.device)
+            publish_device_states(self.device)
+        except Exception as e:
+            g_log.debug(f'Connection: d> {self.device.name} state refresh failed: {repr(e)}')
+        g_reconciler.reconcile(self.device)
+        return light
+
+    def _schedule_retry(self) -> None:
+        if self._closed or self._retry is not None:
+            return
+        delay = min(g_options['reconnect_backoff_max'], g_options['reconnect_backoff_min'] * 2 ** max(0, self.failures - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        g_log.debug(f'Connection: d> {self.device.name} retry #{self.failures} in {delay:.1f}s')
+        self._retry = asyncio.get_running_loop().call_later(delay, self._on_retry)
+
+    def _on_retry(self) -> None:
+        self._retry = None
+        self.connect()
+
+    def _cancel_retry(self) -> None:
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+
+    def _cancel(self) -> None:
+        self._cancel_retry()
+        if self._connecting is not None and not self._connecting.done():
+            self._connecting.cancel()
+        self._connecting = None
+
+# Device circuit breaker
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+
+class DeviceBreaker:
+    # Circuit breaker of a device. Opens after `breaker_threshold` consecutive failures so
+    # actions fail fast instead of waiting on a dead light. While open, the light is only
+    # probed by the background reconnect of its `DeviceConnection`, which moves the breaker
+    # to half-open; a successful handshake closes it, a failed one opens it again.
+    # Must only be used on the Tapo event loop.
+
+    def __init__(self, device_name: str) -> None:
+        self.device_name = device_name
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow_request(self) -> bool:
+        return self.state == BREAKER_CLOSED
+
+    def begin_probe(self) -> None:
+        if self.state == BREAKER_OPEN:
+            self._set_state(BREAKER_HALF_OPEN)
+
+    def record_success(self) -> None:
+        self.failures = 0
+        if self.state != BREAKER_CLOSED:
+            self._set_state(BREAKER_CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == BREAKER_HALF_OPEN or (self.state == BREAKER_CLOSED and self.failures >= max(1, g_options['breaker_threshold'])):
+            self.opened_at = time.monotonic()
+            self._set_state(BREAKER_OPEN)
+
+    def reset(self) -> None:
+        self.failures = 0
+        self.state = BREAKER_CLOSED
+
+    def _set_state(self, state: str) -> None:
+        g_log.info(f'Breaker: d> {self.device_name} {self.state} -> {state} (failures {self.failures})')
+        self.state = state
+
+# Device rate limiter
+
+RATE_LIMIT_INCREASE = 0.5  # requests per second added after each fast answer
+RATE_LIMIT_SLOW_FACTOR = 0.8  # rate kept after a slow answer
+RATE_LIMIT_FAILURE_FACTOR = 0.5  # rate kept after a failed request
+RATE_LIMIT_LOWEST = 0.1  # requests per second a light always gets, whatever the limits say
+
+class DeviceRateLimiter:
+    # Token bucket in front of every request to a light. Bulbs pushed too hard drop
+    # connections or reboot, so the rate is learned AIMD style: it creeps up by
+    # `RATE_LIMIT_INCREASE` after every fast answer, and is cut after a slow answer or a
+    # failure. `rate_limit_*` options are the limits, overridable per device type in the
+    # `rate_limits` config section. Must only be used on the Tapo event loop.
+
+    def __init__(self, device_name: str, device_type: str) -> None:
+        self.device_name = device_name
+        self.device_type = device_type
+        self.delayed = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.rate = self._clamp(self.limit('rate_limit_max'))
+        self.tokens = max(1.0, self.limit('rate_limit_burst'))
+        self.updated_at = time.monotonic()
+
+    def limit(self, option: str) -> float:
+        return g_rate_limits.get(self.device_type, {}).get(option, g_options[option])
+
+    def _clamp(self, rate: float) -> float:
+        # Never 0, the wait for a token divides by the rate
+        return max(RATE_LIMIT_LOWEST, min(max(rate, self.limit('rate_limit_min')), self.limit('rate_limit_max')))
+
+    def reserve(self) -> float:
+        # Takes a token and returns the seconds to wait for it
+        now = time.monotonic()
+        self.rate = self._clamp(self.rate)
+        self.tokens = min(max(1.0, self.limit('rate_limit_burst')), self.tokens + (now - self.updated_at) * self.rate) - 1
+        self.updated_at = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    async def acquire(self) -> None:
+        if (delay := self.reserve()) > 0:
+            self.delayed += 1
+            g_metrics.requests_delayed += 1
+            g_metrics.observe('rate_limit_wait', delay, device=self.device_name)
+            await asyncio.sleep(delay)
+
+    def record_success(self, seconds: float) -> None:
+        if seconds > self.limit('rate_limit_latency'):
+            self._lower(RATE_LIMIT_SLOW_FACTOR, f'slow answer ({seconds:.2f}s)')
+        else:
+            self.rate = self._clamp(self.rate + RATE_LIMIT_INCREASE)
+
+    def record_failure(self) -> None:
+        self._lower(RATE_LIMIT_FAILURE_FACTOR, 'failed request')
+
+    def _lower(self, factor: float, reason: str) -> None:
+        rate = self._clamp(self.rate * factor)
+        if rate < self.rate:
+            g_log.debug(f'Rate limit: d> {self.device_name} {self.rate:.1f} -> {rate:.1f} requests/s after {reason}')
+        self.rate = rate
+
+# Device state cache
+
+class DeviceState:
+    # Last known state of a device, refreshed from `get_device_info` and updated
+    # write-through by the action handlers. `color_temp` is 0 while in color mode.
+    __slots__ = ('device_on', 'brightness', 'hue', 'saturation', 'color_temp', 'refreshed_at')
+
+    def __init__(self) -> None:
+        self.device_on: Optional[bool] = None
+        self.brightness: Optional[int] = None
+        self.hue: Optional[int] = None
+        self.saturation: Optional[int] = None
+        self.color_temp: Optional[int] = None
+        self.refreshed_at = 0.0
+
+    def is_fresh(self, ttl: float) -> bool:
+        return self.device_on is not None and time.monotonic() - self.refreshed_at < ttl
+
+    def refresh(self, device_info: Any) -> None:
+        self.device_on = device_info.device_on
+        # Plugs report no brightness; only color lights report hue,
+        # saturation and color temperature
+        self.brightness = getattr(device_info, 'brightness', None)
+        self.hue = getattr(device_info, 'hue', None)
+        self.saturation = getattr(device_info, 'saturation', None)
+        self.color_temp = getattr(device_info, 'color_temp', None)
+        self.refreshed_at = time.monotonic()
+
+    def update(self, **changes: Any) -> None:
+        for key, value in changes.items():
+            setattr(self, key, value)
+        self.refreshed_at = time.monotonic()
+
+    def invalidate(self) -> None:
+        self.refreshed_at = 0.0
+
+    def matches(self, changes: Dict[str, Any]) -> bool:
+        return all(getattr(self, key) == value for key, value in changes.items())
+
+class DesiredState:
+    # Changes the plugin still owes a light: the targets of commands that could not be
+    # delivered while it was unreachable. Merged latest-wins so they collapse into one
+    # request once the light is back, see `StateReconciler`.
+    __slots__ = ('changes', 'updated_at')
+
+    def __init__(self) -> None:
+        self.changes: Dict[str, Any] = {}
+        self.updated_at = 0.0
+
+    def __bool__(self) -> bool:
+        return bool(self.changes)
+
+    def merge(self, changes: Dict[str, Any]) -> None:
+        self.settle(changes)
+        self.changes.update(changes)
+        self.updated_at = time.monotonic()
+
+    def settle(self, changes: Dict[str, Any]) -> None:
+        # Drops the pending changes that `changes` supersede, once it reached the light or
+        # was merged. Turning the light off supersedes everything, a color and a color
+        # temperature supersede each other.
+        if changes.get('device_on') is False:
+            self.changes.clear()
+            return
+        superseded = set(changes)
+        if changes.get('color_temp'):
+            superseded.update(('hue', 'saturation'))
+        if 'hue' in changes:
+            superseded.add('color_temp')
+        for key in superseded:
+            self.changes.pop(key, None)
+
+    def diff(self, state: DeviceState, trusted: bool) -> Dict[str, Any]:
+        # Pending changes the light doesn't show yet, all of them when its state isn't trusted
+        if not trusted:
+            return dict(self.changes)
+        return {key: value for key, value in self.changes.items() if getattr(state, key) != value}
+
+    def expired(self, ttl: float) -> bool:
+        return bool(self.changes) and time.monotonic() - self.updated_at > ttl
+
+    def clear(self) -> None:
+        self.changes.clear()
+
+async def refresh_device_state(device: Device) -> 'DeviceState':
+    with timed('read', device=device.name):
+        device_info = await asyncio.wait_for(device.light.get_device_info(), g_options['request_timeout'])
+    device.state.refresh(device_info)
+    g_discovery.learn(device, device_info)
+    return device.state
+
+async def get_device_state(device: Device) -> 'DeviceState':
+    # Answers from the cache and only reads the device when the entry is stale or unknown
+    state: DeviceState = device.state
+    if not state.is_fresh(g_options['state_ttl']):
+        await refresh_device_state(device)
+    return state
+
+def update_device_state(device_name: str, **changes: Any) -> None:
+    if (device := g_device_list.get(device_name)):
+        device.state.update(**changes)
+        publish_device_states(device)
+
+# Touch Portal device states
+
+g_published_states: Dict[str, str] = {}
+
+def state_id_name(name: str) -> str:
+    # Light or group name as it appears in state IDs
+    return re.sub(r'[^0-9A-Za-z]+', '_', name)
+
+def device_state_id(device_name: str, key: str) -> str:
+    return f'{PLUGIN_ID}.States.{state_id_name(device_name)}.{key}'
+
+def publish_state(state_id: str, description: str, value: str, parent_group: str) -> None:
+    # Only talks to TP when a state is new or its value actually changed
+    published = g_published_states.get(state_id)
+    if published is None:
+        TPClient.createState(state_id, description, value, parent_group)
+    elif published != value:
+        TPClient.stateUpdate(state_id, value)
+    else:
+        return
+    g_published_states[state_id] = value
+
+def publish_device_states(device: Device, reachable: bool = True) -> None:
+    name = device.name
+    state: DeviceState = device.state
+
+    values = {'Reachable': 'true' if reachable else 'false', 'Circuit': device.breaker.state}
+    if state.device_on is not None:
+        values['On'] = 'ON' if state.device_on else 'OFF'
+    if state.brightness is not None:
+        values['Brightness'] = str(state.brightness)
+    if device.device_type.color and state.hue is not None and state.saturation is not None:
+        values['Color'] = hue_saturation_to_hex(state.hue, state.saturation)
+
+    for key, value in values.items():
+        publish_state(device_state_id(name, key), f'{name} {DEVICE_STATES[key]}', value, name)
+    sync_connectors(device)
+
+def publish_group_states(group_name: str, failed: List[str]) -> None:
+    publish_state(device_state_id(group_name, 'Failed'), f'{group_name} {GROUP_STATES['Failed']}', ', '.join(failed), group_name)
+
+def remove_stale_device_states() -> None:
+    current_ids = {device_state_id(name, key) for name in g_device_list for key in DEVICE_STATES}
+    current_ids |= {device_state_id(name, key) for name in g_group_list for key in GROUP_STATES}
+    for state_id in [state_id for state_id in g_published_states if state_id not in current_ids]:
+        TPClient.removeState(state_id)
+        del g_published_states[state_id]
+
+class DevicePoller:
+    # Background task refreshing every connected device and publishing its states.
+    # Polls fast for a while after an action and slows down once the deck is idle.
+
+    def __init__(self) -> None:
+        self.last_action_at = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        # Must be called on the Tapo event loop
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def notify_action(self) -> None:
+        # Thread-safe: marks user activity so the poller switches to the fast interval
+        self.last_action_at = time.monotonic()
+        if self._wakeup is not None:
+            g_tapo_loop.call_soon(self._wakeup.set)
+
+    def interval(self) -> float:
+        if time.monotonic() - self.last_action_at < g_options['poll_active_window']:
+            return max(LOOP_INTERVAL_MIN, g_options['poll_interval_active'])
+        return max(LOOP_INTERVAL_MIN, g_options['poll_interval_idle'])
+
+    async def _run(self) -> None:
+        while True:
+            await self.poll_all()
+            g_startup_cache.save_if_due()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval())
+                # Woken by an action: give the command time to land before reading back
+                self._wakeup.clear()
+                await asyncio.sleep(g_options['poll_interval_active'])
+            except asyncio.TimeoutError:
+                pass
+
+    async def poll_all(self) -> None:
+        semaphore = asyncio.Semaphore(max(1, g_options['poll_concurrency']))
+        devices = [device for device in g_device_list.values() if device.light]
+        await asyncio.gather(*(self.poll_device(device, semaphore) for device in devices))
+
+    async def poll_device(self, device: Device, semaphore: asyncio.Semaphore) -> None:
+        if len(device.mailbox) or g_effect_scheduler.is_running(device.name):
+            # Commands are pending, the write-through state is more recent than a read
+            return
+        async with semaphore:
+            try:
+                async with g_request_scheduler.slot(device.name, PRIORITY_BACKGROUND):
+                    await refresh_device_state(device)
+                device.breaker.record_success()
+                publish_device_states(device)
+            except Exception as e:
+                # The idle poll doubles as a keepalive: a dead session is found and
+                # reconnected in the background rather than on the next button press
+                g_log.debug(f'Poll: d> {device.name} failed: {repr(e)}')
+                g_metrics.keepalive_failures += 1
+                device.state.invalidate()
+                device.breaker.record_failure()
+                device.connection.reset()
+                publish_device_states(device, reachable=False)
+
+g_poller = DevicePoller()
+
+# Session keeper
+
+SESSION_CHECK_INTERVAL = 60.0  # longest time between checks for sessions due for a refresh
+
+class SessionKeeper:
+    # Background task renewing light sessions shortly before `session_refresh_age`.
+    # Lights with pending commands are skipped until their mailbox is empty.
+
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        # Must be called on the Tapo event loop
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            # A disabled keeper keeps checking so a config reload can turn it on
+            await asyncio.sleep(max(LOOP_INTERVAL_MIN, min(SESSION_CHECK_INTERVAL, g_options['session_refresh_age'] / 10 or SESSION_CHECK_INTERVAL)))
+            devices = [device for device in g_device_list.values() if device.connection.refresh_due() and not len(device.mailbox)]
+            if devices:
+                semaphore = asyncio.Semaphore(max(1, g_options['poll_concurrency']))
+                await asyncio.gather(*(self.refresh_device(device, semaphore) for device in devices))
+
+    async def refresh_device(self, device: Device, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            await device.connection.refresh()
+
+g_session_keeper = SessionKeeper()
+
+# Config watcher
+
+class ConfigWatcher:
+    # Background task polling the config file and reloading it when it changes.
+    # A change is only applied once the file has stayed the same for one more check,
+    # so a file still being written by an editor isn't read half way.
+
+    def __init__(self) -> None:
+        self.file_path: Optional[str] = None
+        self._applied: Optional[Tuple[int, int]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def watch(self, file_path: str) -> None:
+        # Must be called on the Tapo event loop, right after the file was loaded
+        self.file_path = file_path
+        self._applied = self.signature()
+        if g_options['config_watch_interval'] > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.file_path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
 
-    if any(filtered_choices['RGB_Bright']):
-        TPClient.choiceUpdate(TP_PLUGIN_ACTIONS['RGB_Bright']['data']['device_list']['id'], filtered_choices['RGB_Bright'])
+    async def _run(self) -> None:
+        pending: Optional[Tuple[int, int]] = None
+        while g_options['config_watch_interval'] > 0:
+            await asyncio.sleep(max(LOOP_INTERVAL_MIN, g_options['config_watch_interval']))
+            signature = self.signature()
+            if signature is None or signature == self._applied:
+                pending = None
+            elif signature != pending:
+                pending = signature
+            else:
+                g_log.info(f'Config file changed: {self.file_path}')
+                pending = None
+                self._applied = signature
+                connect_devices(load_config(self.file_path))
+
+g_config_watcher = ConfigWatcher()
+
+# LAN discovery
+
+DISCOVERY_FAILURES = 2  # consecutive failed handshakes after which a light is looked for on the LAN
+DISCOVERY_SAVE_DELAY = 2.0  # seconds changes are collected before the discovery cache is written
+
+def discovered_model(device_model: str) -> str:
+    # Discovery reports e.g. 'L530E(EU)' where the config uses 'L530'
+    match = re.match(r'[A-Z]+\d+', device_model)
+    return match.group(0) if match else device_model
+
+def moved_address(address: str, ipaddress: str) -> str:
+    # Keeps an explicit port of the configured address
+    _, separator, port = address.partition(':')
+    return f'{ipaddress}:{port}' if separator else ipaddress
+
+def normalized_mac(mac: Optional[str]) -> str:
+    return (mac or '').upper().replace(':', '-')
+
+def discovery_targets() -> List[str]:
+    # The configured addresses, or the /24 broadcast address of every light
+    if g_options['discovery_subnets']:
+        return [target.strip() for target in g_options['discovery_subnets'].split(',') if target.strip()]
+    targets: Dict[str, None] = {}
+    for device in g_device_list.values():
+        for address in (device.configured_ip, device.ipaddress):
+            parts = address.partition(':')[0].split('.')
+            if len(parts) == 4 and all(part.isdigit() for part in parts):
+                targets['.'.join(parts[:3]) + '.255'] = None
+    return list(targets)
+
+class DeviceDiscovery:
+    # Finds lights that stopped answering because DHCP gave them another address. Lights
+    # are recognized by the device ID and MAC learned from `get_device_info`, moved lights
+    # are rebound in `g_device_list` and reconnected. Identities, new addresses and the
+    # time of the last scan are kept next to the config file, so a restart reaches moved
+    # lights right away instead of scanning again. Must only be used on the Tapo event loop.
+
+    def __init__(self) -> None:
+        self.file_path: Optional[str] = None
+        self._known: Dict[str, Dict[str, Any]] = {}  # device name -> identity and address
+        self._scanned_at: Optional[float] = None
+        self._proposed: Set[str] = set()  # addresses of unconfigured devices already logged
+        self._task: Optional[asyncio.Task] = None
+        self._save: Optional[asyncio.TimerHandle] = None
+
+    def load(self, file_path: str) -> None:
+        if file_path == self.file_path:
+            return
+        self.file_path = file_path
+        self._known = {}
+        if not os.path.exists(file_path):
+            return
+        try:
+            with open(file_path, 'r') as file:
+                data = json.load(file)
+        except Exception as e:
+            g_log.warning(f'Error reading discovery cache {file_path}: {repr(e)}')
+            return
+        self._known = data.get('devices', {})
+        if (scanned_at := data.get('scanned_at')):
+            self._scanned_at = time.monotonic() - max(0.0, time.time() - scanned_at)
+
+    def apply(self, device: Device) -> None:
+        # Reuses what is known about a new device, unless the config entry changed since
+        entry = self._known.get(device.name)
+        if not entry or entry.get('configured_ip') != device.configured_ip or entry.get('type') != device.type:
+            return
+        device.device_id, device.mac = entry.get('device_id'), entry.get('mac')
+        if entry.get('ip') and entry['ip'] != device.ipaddress:
+            g_log.info(f'Discovery: d> {device.name} is at {entry["ip"]} instead of {device.configured_ip}')
+            device.ipaddress = entry['ip']
+
+    def learn(self, device: Device, device_info: Any) -> None:
+        device_id, mac = getattr(device_info, 'device_id', None), getattr(device_info, 'mac', None)
+        if device_id == device.device_id and mac == device.mac:
+            return
+        device.device_id, device.mac = device_id, mac
+        self.remember(device)
+
+    def remember(self, device: Device) -> None:
+        self._known[device.name] = {
+            'type': device.type,
+            'device_id': device.device_id,
+            'mac': device.mac,
+            'configured_ip': device.configured_ip,
+            'ip': device.ipaddress,
+        }
+        if self._save is None:
+            # Lights connecting together are written at once
+            self._save = asyncio.get_running_loop().call_later(DISCOVERY_SAVE_DELAY, self.save)
+
+    def flush(self) -> None:
+        # Writes changes still waiting for `DISCOVERY_SAVE_DELAY`
+        if self._save is not None:
+            self.save()
+
+    def save(self) -> None:
+        if self._save is not None:
+            self._save.cancel()
+            self._save = None
+        if not self.file_path:
+            return
+        scanned_at = None if self._scanned_at is None else int(time.time() - (time.monotonic() - self._scanned_at))
+        try:
+            temp_path = self.file_path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump({'scanned_at': scanned_at, 'devices': self._known}, file, indent=2)
+            os.replace(temp_path, self.file_path)
+        except Exception as e:
+            g_log.warning(f'Error writing discovery cache {self.file_path}: {repr(e)}')
+
+    def request(self) -> None:
+        # Starts a scan unless one is running or the last one was less than `discovery_interval` ago
+        interval = g_options['discovery_interval']
+        if interval <= 0 or (self._task is not None and not self._task.done()):
+            return
+        if self._scanned_at is not None and time.monotonic() - self._scanned_at < interval:
+            return
+        self._scanned_at = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self._task.add_done_callback(log_future_exception)
+
+    async def _run(self) -> None:
+        g_metrics.discovery_scans += 1
+        found = await self.scan(discovery_targets())
+        self.resolve(found)
+        self.save()
+
+    async def scan(self, targets: List[str]) -> Dict[str, Dict[str, Any]]:
+        # Probes the targets a few at a time within `discovery_budget`. Returns the
+        # discovery result of every device that answered by its IP address.
+        from tapo import ApiClient
+
+        found: Dict[str, Dict[str, Any]] = {}
+        semaphore = asyncio.Semaphore(max(1, g_options['discovery_concurrency']))
+        timeout = min(60, max(1, g_options['discovery_timeout']))
+
+        async def probe(target: str) -> None:
+            async with semaphore:
+                try:
+                    async for answer in await ApiClient.discover_devices_raw(target, timeout):
+                        try:
+                            result = answer.get()
+                        except Exception as e:
+                            g_log.debug(f'Discovery: unreadable answer to {target}: {repr(e)}')
+                            continue
+                        if result.message.get('error_code') == 0:
+                            found[result.ip] = result.message.get('result', {})
+                except Exception as e:
+                    g_log.warning(f'Discovery: error scanning {target}: {repr(e)}')
+
+        started = time.monotonic()
+        with timed('discovery'):
+            try:
+                await asyncio.wait_for(asyncio.gather(*(probe(target) for target in targets)), g_options['discovery_budget'])
+            except asyncio.TimeoutError:
+                g_log.info(f'Discovery: scan stopped after {g_options["discovery_budget"]}s, some addresses were skipped')
+        g_log.info(f'Discovery: {len(found)} devices answered on {len(targets)} addresses in {time.monotonic() - started:.1f}s')
+        return found
+
+    def resolve(self, found: Dict[str, Dict[str, Any]]) -> None:
+        by_id = {result.get('device_id'): ipaddress for ipaddress, result in found.items()}
+        by_mac = {normalized_mac(result.get('mac')): ipaddress for ipaddress, result in found.items()}
+        configured: Set[str] = set()
+        for device in list(g_device_list.values()):
+            ipaddress = by_id.get(device.device_id) if device.device_id else None
+            if ipaddress is None and device.mac:
+                ipaddress = by_mac.get(normalized_mac(device.mac))
+            configured.add(ipaddress or device.ipaddress.partition(':')[0])
+            if ipaddress is None or ipaddress == device.ipaddress.partition(':')[0]:
+                continue
+            if (model := discovered_model(found[ipaddress].get('device_model', ''))) != device.type:
+                g_log.warning(f'Discovery: d> {device.name} found at {ipaddress} as {model}, but it is configured as {device.type}')
+                continue
+            self.rebind(device, ipaddress)
+        if g_options['discovery_propose']:
+            self.propose(found, configured)
+
+    def rebind(self, device: Device, ipaddress: str) -> None:
+        address = moved_address(device.ipaddress, ipaddress)
+        g_log.info(f'Discovery: d> {device.name} moved from {device.ipaddress} to {address}')
+        g_device_list.rebind(device, address)
+        g_metrics.devices_rebound += 1
+        self.remember(device)
+        device.connection.restart()
+
+    def propose(self, found: Dict[str, Dict[str, Any]], configured: Set[str]) -> None:
+        for ipaddress, result in found.items():
+            model = discovered_model(result.get('device_model', ''))
+            if ipaddress in configured or ipaddress in self._proposed or model not in DEVICE_TYPES:
+                continue
+            self._proposed.add(ipaddress)
+            g_log.info(f'Discovery: {model} {result.get("mac")} at {ipaddress} is not in the config, '
+                       f'add it as: {model}: [{{name: <name>, ip: {ipaddress}}}]')
+
+g_discovery = DeviceDiscovery()
+
+# Metrics
+
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_WINDOW = 256  # recent samples per series used for percentiles
+
+class LatencyHistogram:
+    # Cumulative buckets for the metrics file plus a rolling window of recent samples
+    __slots__ = ('buckets', 'count', 'total', 'recent')
+
+    def __init__(self) -> None:
+        self.buckets = [0] * len(METRICS_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.recent: Deque[float] = deque(maxlen=METRICS_WINDOW)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+        for index, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class PluginMetrics:
+    # Time spent per plugin stage, kept per action type and per device. Stages are
+    # dispatch/parse (TP worker threads), queue_wait, priority_wait (labelled with the
+    # priority class), rate_limit_wait, request, action (end-to-end), handshake,
+    # session_refresh, read, update_choices and discovery. Observed from several threads, hence the lock.
+
+    def __init__(self) -> None:
+        self.completed = 0
+        self.session_refreshes = 0
+        self.session_refresh_failures = 0
+        self.keepalive_failures = 0
+        self.effect_frames = 0
+        self.effect_frames_skipped = 0
+        self.requests_delayed = 0
+        self.requests_skipped = 0
+        self.changes_deferred = 0
+        self.reconciles = 0
+        self.discovery_scans = 0
+        self.devices_rebound = 0
+        self.connections_released = 0
+        self._series: Dict[Tuple[str, str, str], LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, action: str = '', device: str = '') -> None:
+        keys = [(stage, 'action', action)] if action else []
+        if device:
+            keys.append((stage, 'device', device))
+        with self._lock:
+            for key in keys or [(stage, '', '')]:
+                if (histogram := self._series.get(key)) is None:
+                    histogram = self._series[key] = LatencyHistogram()
+                histogram.observe(seconds)
+
+    def percentile(self, stage: str, dimension: str, value: str, fraction: float) -> Optional[float]:
+        with self._lock:
+            histogram = self._series.get((stage, dimension, value))
+            return histogram.percentile(fraction) if histogram else None
+
+    def prometheus_text(self) -> str:
+        lines = [
+            '# HELP tapo_plugin_stage_seconds Time spent in a plugin stage.',
+            '# TYPE tapo_plugin_stage_seconds histogram',
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+            for (stage, dimension, value), histogram in series:
+                labels = f'stage="{stage}"' + (f',{dimension}="{prometheus_escape(value)}"' if dimension else '')
+                for bound, count in zip(METRICS_BUCKETS, histogram.buckets):
+                    lines.append(f'tapo_plugin_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'tapo_plugin_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'tapo_plugin_stage_seconds_sum{{{labels}}} {histogram.total:.6f}')
+                lines.append(f'tapo_plugin_stage_seconds_count{{{labels}}} {histogram.count}')
+        for name, value, doc in (
+            ('tapo_plugin_commands_completed_total', self.completed, 'Device commands that reached their light.'),
+            ('tapo_plugin_commands_coalesced_total', g_coalesced_commands, 'Device commands superseded by a newer one.'),
+            ('tapo_plugin_commands_fused_total', g_fused_commands, 'Device commands merged into a shared request.'),
+            ('tapo_plugin_session_refreshes_total', self.session_refreshes, 'Light sessions renewed ahead of their expiry.'),
+            ('tapo_plugin_session_refresh_failures_total', self.session_refresh_failures, 'Light session renewals that failed.'),
+            ('tapo_plugin_keepalive_failures_total', self.keepalive_failures, 'Background polls that found a dead session.'),
+            ('tapo_plugin_effect_frames_total', self.effect_frames, 'Effect frames sent to lights.'),
+            ('tapo_plugin_effect_frames_skipped_total', self.effect_frames_skipped, 'Effect frames skipped because a light fell behind.'),
+            ('tapo_plugin_requests_delayed_total', self.requests_delayed, 'Requests held back by the rate limit of their light.'),
+            ('tapo_plugin_requests_skipped_total', self.requests_skipped, 'Device commands skipped because the light already showed their state.'),
+            ('tapo_plugin_changes_deferred_total', self.changes_deferred, 'Device commands kept for a light that was unreachable.'),
+            ('tapo_plugin_reconciles_total', self.reconciles, 'Requests delivering kept changes to a light that came back.'),
+            ('tapo_plugin_discovery_scans_total', self.discovery_scans, 'LAN scans for lights that stopped answering.'),
+            ('tapo_plugin_devices_rebound_total', self.devices_rebound, 'Lights found at a new address by a LAN scan.'),
+            ('tapo_plugin_connections_released_total', self.connections_released, 'Idle light connections closed to stay within max_connections.'),
+        ):
+            lines += [f'# HELP {name} {doc}', f'# TYPE {name} counter', f'{name} {value}']
+        lines += ['# HELP tapo_plugin_requests_waiting Requests waiting for their turn, by priority class.',
+                  '# TYPE tapo_plugin_requests_waiting gauge']
+        for priority, waiting in zip(PRIORITY_NAMES, g_request_scheduler.waiting):
+            lines.append(f'tapo_plugin_requests_waiting{{priority="{priority}"}} {waiting}')
+        lines += ['# HELP tapo_plugin_rate_limit Requests per second currently allowed per light.',
+                  '# TYPE tapo_plugin_rate_limit gauge']
+        for device in list(g_device_list.values()):
+            lines.append(f'tapo_plugin_rate_limit{{device="{prometheus_escape(device.name)}"}} {device.limiter.rate:.2f}')
+        accounts = g_client_pool.report()
+        for key, doc in (
+            ('lights', 'Lights configured per account.'),
+            ('connections', 'Open light connections per account.'),
+            ('memory_bytes', 'Process memory attributed to the open connections of an account, estimated.'),
+        ):
+            name = f'tapo_plugin_account_{key}'
+            lines += [f'# HELP {name} {doc}', f'# TYPE {name} gauge']
+            for account, entry in accounts.items():
+                lines.append(f'{name}{{account="{prometheus_escape(account)}"}} {entry[key]}')
+        if (memory := process_memory()) is not None:
+            lines += ['# HELP tapo_plugin_memory_bytes Resident memory of the plugin process.', '# TYPE tapo_plugin_memory_bytes gauge',
+                      f'tapo_plugin_memory_bytes {memory}']
+        return '\n'.join(lines) + '\n'
+
+def prometheus_escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+g_metrics = PluginMetrics()
+
+@contextmanager
+def timed(stage: str, action: str = '', device: str = '') -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        g_metrics.observe(stage, time.perf_counter() - started, action, device)
+
+def debug_enabled() -> bool:
+    # Guards debug logs whose arguments are expensive to format
+    return g_log.logger.isEnabledFor(logging.DEBUG)
+
+class MetricsReporter:
+    # Background task publishing metrics summaries as TP states and writing the metrics file
+
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+        self._completed = 0
+        self._reported_at = time.monotonic()
+
+    def start(self) -> None:
+        # Must be called on the Tapo event loop
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            # A disabled reporter keeps checking so a config reload can turn it on
+            await asyncio.sleep(max(LOOP_INTERVAL_MIN, g_options['metrics_interval'] or 60.0))
+            if g_options['metrics_interval'] <= 0:
+                continue
+            try:
+                if g_options['metrics_states']:
+                    self.publish_states()
+                if g_options['metrics_file']:
+                    await asyncio.get_running_loop().run_in_executor(None, write_metrics_file, g_options['metrics_file'], g_metrics.prometheus_text())
+            except Exception as e:
+                g_log.warning(f'Metrics: report failed: {repr(e)}')
+
+    def publish_states(self) -> None:
+        now = time.monotonic()
+        throughput = (g_metrics.completed - self._completed) / max(now - self._reported_at, 1e-6)
+        self._completed, self._reported_at = g_metrics.completed, now
+
+        publish_state(f'{PLUGIN_ID}.States.Metrics.Throughput', 'Metrics Commands per second', f'{throughput:.2f}', 'Metrics')
+        for action in TP_PLUGIN_ACTIONS:
+            if (p95 := g_metrics.percentile('action', 'action', action, 0.95)) is not None:
+                publish_state(f'{PLUGIN_ID}.States.Metrics.{action}.p95', f'Metrics {TP_PLUGIN_ACTIONS[action]['name']} p95 (ms)', f'{p95 * 1000:.0f}', 'Metrics')
+        for name in g_device_list:
+            if (p95 := g_metrics.percentile('request', 'device', name, 0.95)) is not None:
+                publish_state(device_state_id(name, 'Latency'), f'{name} {DEVICE_STATES['Latency']}', f'{p95 * 1000:.0f}', name)
+        for account, entry in g_client_pool.report().items():
+            publish_state(f'{PLUGIN_ID}.States.Metrics.Account.{account}.Connections', f'Metrics {account} account connections',
+                          f'{entry['connections']}/{entry['lights']}', 'Metrics')
+            publish_state(f'{PLUGIN_ID}.States.Metrics.Account.{account}.Memory', f'Metrics {account} account memory (MB)',
+                          f'{entry['memory_bytes'] / 1048576:.1f}', 'Metrics')
+
+def write_metrics_file(file_path: str, text: str) -> None:
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(text)
+    os.replace(temp_path, file_path)
+
+g_metrics_reporter = MetricsReporter()
+
+# Device command mailbox
+
+# Actions whose pending commands can be superseded by a newer one of the same kind.
+# Anything else (On_Off, Toggle) acts as a barrier and keeps strict ordering.
+COALESCED_ACTIONS = {'Bright', 'RGB', 'ColorTemperature', 'RGB_Bright'}
+
+# Commands a color light can merge into a single `set()` builder request, On_Off only when turning on
+FUSED_ACTIONS = {'On_Off', 'Bright', 'RGB', 'ColorTemperature', 'RGB_Bright'}
+FUSED_ACTION = 'Fused'
+
+# Internal command carrying one frame of an effect, see `EffectScheduler`
+EFFECT_FRAME_ACTION = 'EffectFrame'
+
+g_coalesced_commands = 0
+g_fused_commands = 0
+g_fused_requests = 0
+
+class DeviceCommand:
+    # `done` is resolved with the outcome of the command when a caller waits for it,
+    # `limit` bounds how many commands sharing it run at the same time (group fan-out).
+    # TP actions carry their decoded `ActionValues`, internal commands the device state changes.
+    __slots__ = ('aid', 'action', 'values', 'done', 'limit', 'created_at')
+
+    def __init__(self, aid: str, action: str, values: Dict[str, Any],
+                 done: Optional[asyncio.Future] = None, limit: Optional[asyncio.Semaphore] = None) -> None:
+        self.aid = aid
+        self.action = action
+        self.values = values
+        self.done = done
+        self.limit = limit
+        self.created_at = time.perf_counter()
+
+    def resolve(self, result: bool) -> None:
+        if self.done is not None and not self.done.done():
+            self.done.set_result(result)
+
+    def is_fusable(self) -> bool:
+        if self.action == 'On_Off':
+            return self.values['on_off'] == 'ON'
+        return self.action in FUSED_ACTIONS
+
+    def changes(self) -> Dict[str, Any]:
+        # Device state changes requested by a fusable command
+        values = self.values
+        changes: Dict[str, Any] = {'device_on': True}
+        if 'bright' in values:
+            changes['brightness'] = values['bright']
+        if 'rgb' in values:
+            hue, saturation = values['rgb']
+            changes.update(hue=hue, saturation=saturation, color_temp=0)
+        if 'temperature' in values:
+            changes['color_temp'] = values['temperature']
+        return changes
+
+    def target(self) -> Optional[Dict[str, Any]]:
+        # Device state the command sets, None when it depends on the light (Toggle, scenes)
+        # or is transient (effect frames)
+        if self.action in (FUSED_ACTION, CONNECTOR_ACTION):
+            return self.values
+        if self.action == 'On_Off':
+            return {'device_on': self.values['on_off'] == 'ON'}
+        if self.action in FUSED_ACTIONS:
+            return self.changes()
+        return None
 
-    if any(filtered_choices['ColorTemperature']):
-        TPClient.choiceUpdate(TP_PLUGIN_ACTIONS['ColorTemperature']['data']['device_list']['id'], filtered_choices['ColorTemperature'])
+class DeviceMailbox:
+    # Per-device queue of pending commands drained by a single worker task on the
+    # Tapo event loop, so a device only ever has one request in flight.
+    # Color lights fuse consecutive power/brightness/color commands into a single request.
+    # `post` must be called on the Tapo event loop.
+
+    def __init__(self, device_name: str, fusable: bool = False) -> None:
+        self.device_name = device_name
+        self.fusable = fusable
+        self.coalesced = 0
+        self.fused = 0
+        self._pending: Deque[DeviceCommand] = deque()
+        self._worker: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def post(self, command: DeviceCommand) -> None:
+        global g_coalesced_commands
+
+        if command.action != EFFECT_FRAME_ACTION:
+            # Any other command takes over the light from a running effect
+            g_effect_scheduler.cancel(self.device_name)
+
+        if command.action in COALESCED_ACTIONS:
+            # Latest wins: drop a superseded command of the same kind, but never look
+            # past an ordered command so ON/OFF/Toggle sequencing is preserved
+            for index in range(len(self._pending) - 1, -1, -1):
+                pending = self._pending[index]
+                if pending.action not in COALESCED_ACTIONS:
+                    break
+                if pending.action == command.action:
+                    del self._pending[index]
+                    # The newer command delivers what the superseded one asked for
+                    pending.resolve(True)
+                    self.coalesced += 1
+                    g_coalesced_commands += 1
+                    g_log.debug(f'Mailbox: {self.device_name} | coalesced {command.action} (total {g_coalesced_commands})')
+                    break
+
+        self._pending.append(command)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._drain())
+
+    async def _drain(self) -> None:
+        while self._pending:
+            if self.fusable and g_options['batch_window'] > 0 and self._pending[0].is_fusable():
+                # Give related changes a moment to arrive so they can share one request
+                await asyncio.sleep(g_options['batch_window'])
+
+            batch = self._take_batch()
+            command = batch[0] if len(batch) == 1 else self._fuse(batch)
+            limit = next((pending.limit for pending in batch if pending.limit is not None), None)
+            if limit is not None:
+                async with limit:
+                    result = await execute_command(self.device_name, command)
+            else:
+                result = await execute_command(self.device_name, command)
+            for pending in batch:
+                pending.resolve(result)
+
+    def _take_batch(self) -> list:
+        batch = [self._pending.popleft()]
+        if self.fusable and batch[0].is_fusable():
+            while self._pending and self._pending[0].is_fusable():
+                batch.append(self._pending.popleft())
+        return batch
+
+    def _fuse(self, batch: list) -> DeviceCommand:
+        global g_fused_commands, g_fused_requests
+
+        changes: Dict[str, Any] = {}
+        for pending in batch:
+            changes.update(pending.changes())
+        if changes.get('color_temp'):
+            # The latest color change was a temperature, a hue from before it no longer applies
+            changes.pop('hue', None)
+            changes.pop('saturation', None)
+
+        self.fused += len(batch)
+        g_fused_commands += len(batch)
+        g_fused_requests += 1
+        g_log.debug(f'Mailbox: {self.device_name} | fused {[pending.action for pending in batch]} into one request (total {g_fused_commands} in {g_fused_requests})')
+        command = DeviceCommand(batch[-1].aid, FUSED_ACTION, changes)
+        command.created_at = batch[0].created_at
+        return command
+
+# Write-behind
+
+# Internal command delivering the pending changes of a light, see `StateReconciler`
+RECONCILE_ACTION = 'Reconcile'
+RECONCILE_ID = PLUGIN_ID + '.Reconcile'
+
+RECONCILE_CHECK_INTERVAL = 5.0  # seconds between checks for lights with pending changes
+
+def defer_changes(device: Device, changes: Optional[Dict[str, Any]]) -> None:
+    # Keeps the changes of a command that didn't reach the light for when it is back
+    if not changes or g_options['write_behind_ttl'] <= 0:
+        return
+    device.desired.merge(changes)
+    g_metrics.changes_deferred += 1
+    g_log.debug(f'Reconcile: d> {device.name} keeps {device.desired.changes} until the light is back')
+
+class StateReconciler:
+    # Converges lights toward their `DesiredState`. A light gets its pending changes as a
+    # single request right after it reconnects, the background check covers lights that
+    # came back otherwise and drops changes older than `write_behind_ttl`.
+    # Must only be used on the Tapo event loop.
+
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+        self._posted: Set[str] = set()  # names of lights with a reconcile command in their mailbox
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(RECONCILE_CHECK_INTERVAL)
+            for device in list(g_device_list.values()):
+                if device.desired and (device.light or device.desired.expired(g_options['write_behind_ttl'])):
+                    self.reconcile(device)
+
+    def reconcile(self, device: Device) -> None:
+        desired: DesiredState = device.desired
+        if not desired or device.name in self._posted:
+            return
+        if desired.expired(g_options['write_behind_ttl']):
+            g_log.info(f'Reconcile: d> {device.name} dropped changes the light missed: {desired.changes}')
+            desired.clear()
+            return
+        if not desired.diff(device.state, device.state.is_fresh(g_options['state_ttl'])):
+            # The light got there on its own, e.g. from another app
+            desired.clear()
+            return
+
+        done = asyncio.get_running_loop().create_future()
+        done.add_done_callback(lambda _: self._posted.discard(device.name))
+        self._posted.add(device.name)
+        g_log.debug(f'Reconcile: d> {device.name} applying {desired.changes}')
+        device.mailbox.post(DeviceCommand(RECONCILE_ID, RECONCILE_ACTION, {}, done))
+
+g_reconciler = StateReconciler()
+
+# Connectors
+
+# Internal command carrying slider values, see `ConnectorStreamer`
+CONNECTOR_ACTION = 'Connector'
+
+COLOR_TEMPERATURE_MIN = 2500
+COLOR_TEMPERATURE_MAX = 6500
+
+CONNECTOR_SETTLE_DELAY = 0.25  # seconds without slider moves after which the final value is sent
+CONNECTOR_SYNC_HOLD = 1.0  # seconds after the last slider move during which the light doesn't move the slider
+
+def connector_changes(device: Device, values: Dict[str, int]) -> Dict[str, Any]:
+    # Device state changes for slider values from 0 to 100
+    state: DeviceState = device.state
+    changes: Dict[str, Any] = {'device_on': True}
+    if 'Bright' in values:
+        changes['brightness'] = max(1, values['Bright'])
+    if 'ColorTemperature' in values:
+        changes['color_temp'] = round(COLOR_TEMPERATURE_MIN + (COLOR_TEMPERATURE_MAX - COLOR_TEMPERATURE_MIN) * values['ColorTemperature'] / 100)
+    elif 'Hue' in values or 'Saturation' in values:
+        # Hue and saturation are sent together, the one not moved keeps the light's value
+        changes['hue'] = round(values['Hue'] * 3.6) if 'Hue' in values else state.hue or 0
+        changes['saturation'] = max(1, values['Saturation']) if 'Saturation' in values else state.saturation or 100
+        changes['color_temp'] = 0
+    return changes
+
+def connector_values(state: 'DeviceState') -> Dict[str, int]:
+    # Slider positions from 0 to 100 for the known values of a device state
+    values: Dict[str, int] = {}
+    if state.brightness is not None:
+        values['Bright'] = state.brightness
+    if state.color_temp:
+        values['ColorTemperature'] = round((state.color_temp - COLOR_TEMPERATURE_MIN) * 100 / (COLOR_TEMPERATURE_MAX - COLOR_TEMPERATURE_MIN))
+    if state.hue is not None:
+        values['Hue'] = round(state.hue / 3.6)
+    if state.saturation is not None:
+        values['Saturation'] = state.saturation
+    return {connector: min(100, max(0, value)) for connector, value in values.items()}
+
+class ConnectorStream:
+    # Slider values of one light on their way to it
+    __slots__ = ('device_name', 'targets', 'sent', 'sent_at', 'moved_at', 'in_flight', 'timer')
+
+    def __init__(self, device_name: str) -> None:
+        self.device_name = device_name
+        self.targets: Dict[str, int] = {}
+        self.sent: Dict[str, int] = {}
+        self.sent_at = 0.0
+        self.moved_at = 0.0
+        self.in_flight = False
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+class ConnectorStreamer:
+    # Streams slider moves to the lights. A light gets the latest slider value at most
+    # `connector_max_rate` times a second and never before it answered the previous one.
+    # While dragging, moves smaller than `connector_min_step` wait; once the slider
+    # stops for `CONNECTOR_SETTLE_DELAY` the exact final value is always sent.
+    # Must only be used on the Tapo event loop.
+
+    def __init__(self) -> None:
+        self._streams: Dict[str, ConnectorStream] = {}
+
+    def submit(self, device_name: str, connector: str, value: int) -> None:
+        if (stream := self._streams.get(device_name)) is None:
+            stream = self._streams[device_name] = ConnectorStream(device_name)
+        stream.targets[connector] = value
+        stream.moved_at = time.monotonic()
+        self._schedule(stream)
+
+    def is_streaming(self, device_name: str) -> bool:
+        stream = self._streams.get(device_name)
+        return stream is not None and (stream.in_flight or stream.timer is not None or time.monotonic() - stream.moved_at < CONNECTOR_SYNC_HOLD)
+
+    def _schedule(self, stream: ConnectorStream, delay: Optional[float] = None) -> None:
+        if stream.in_flight or stream.timer is not None:
+            return
+        if delay is None:
+            delay = max(0.0, stream.sent_at + 1.0 / max(g_options['connector_max_rate'], 0.1) - time.monotonic())
+        stream.timer = asyncio.get_running_loop().call_later(delay, self._flush, stream)
+
+    def _flush(self, stream: ConnectorStream) -> None:
+        stream.timer = None
+        device = g_device_list.get(stream.device_name)
+        if device is None:
+            self._streams.pop(stream.device_name, None)
+            return
+
+        now = time.monotonic()
+        settled = now - stream.moved_at >= CONNECTOR_SETTLE_DELAY
+        unsent = {connector: value for connector, value in stream.targets.items() if value != stream.sent.get(connector)}
+        values = {connector: value for connector, value in unsent.items()
+                  if settled or abs(value - stream.sent.get(connector, -100)) >= g_options['connector_min_step']}
+        if not values:
+            if unsent:
+                # Small moves wait for the slider to settle
+                self._schedule(stream, CONNECTOR_SETTLE_DELAY - (now - stream.moved_at))
+            return
+
+        stream.sent.update(values)
+        stream.sent_at = now
+        stream.in_flight = True
+        done = asyncio.get_running_loop().create_future()
+        done.add_done_callback(lambda future: self._sent(stream))
+        device.mailbox.post(DeviceCommand(TP_PLUGIN_CONNECTORS[next(iter(values))]['id'], CONNECTOR_ACTION, connector_changes(device, values), done))
+
+    def _sent(self, stream: ConnectorStream) -> None:
+        stream.in_flight = False
+        if any(value != stream.sent.get(connector) for connector, value in stream.targets.items()):
+            self._schedule(stream)
+
+g_connector_streamer = ConnectorStreamer()
+
+g_published_connectors: Dict[str, int] = {}
+g_oversized_connectors: Set[str] = set()  # update IDs too long to send, warned about once
+
+CONNECTOR_UPDATE_ID_MAX = 200  # characters Touch Portal accepts in a connector update ID, prefix included
+CONNECTOR_UPDATE_ID_PREFIX = f'pc_{PLUGIN_ID}_'  # added by `TPClient.connectorUpdate`
+
+def connector_update_id(connector: str, device_name: str) -> str:
+    definition = TP_PLUGIN_CONNECTORS[connector]
+    return f'{definition['id']}|{definition['data']['device_list']['id']}={device_name}'
+
+def publish_connector(connector: str, device_name: str, value: int) -> None:
+    # Moves a slider, only when its position changed
+    update_id = connector_update_id(connector, device_name)
+    if len(CONNECTOR_UPDATE_ID_PREFIX) + len(update_id) > CONNECTOR_UPDATE_ID_MAX:
+        # Touch Portal drops it without an error, the slider would just stay put
+        if update_id not in g_oversized_connectors:
+            g_oversized_connectors.add(update_id)
+            longest = CONNECTOR_UPDATE_ID_MAX - len(CONNECTOR_UPDATE_ID_PREFIX) - len(connector_update_id(connector, ''))
+            g_log.warning(f'{TP_PLUGIN_CONNECTORS[connector]['name']} of {device_name} is not synced: the name is too long for a '
+                          f'connector update ID, use at most {longest} characters')
+        return
+    if g_published_connectors.get(update_id) != value:
+        TPClient.connectorUpdate(update_id, value)
+        g_published_connectors[update_id] = value
+
+def sync_connectors(device: Device) -> None:
+    # Moves the sliders of a light, and of the groups it belongs to, to its actual state.
+    # A slider being dragged is left alone.
+    name = device.name
+    if g_connector_streamer.is_streaming(name):
+        return
+    for connector, value in connector_values(device.state).items():
+        if device.supports(CONNECTOR_ACTIONS[connector]):
+            publish_connector(connector, name, value)
+
+    for group_name, members in g_group_list.items():
+        if name not in members:
+            continue
+        # A group slider shows the average of its lights
+        member_values: Dict[str, List[int]] = {}
+        for member in members:
+            if (member_device := g_device_list.get(member)) is None or g_connector_streamer.is_streaming(member):
+                continue
+            for connector, value in connector_values(member_device.state).items():
+                if member_device.supports(CONNECTOR_ACTIONS[connector]):
+                    member_values.setdefault(connector, []).append(value)
+        for connector, values in member_values.items():
+            publish_connector(connector, group_name, round(sum(values) / len(values)))
+
+def start_connector_stream(target: str, connector: str, value: int) -> None:
+    # Must be called on the Tapo event loop
+    for name in [target] if target in g_device_list else g_group_list.get(target, []):
+        if (device := g_device_list.get(name)) and device.supports(CONNECTOR_ACTIONS[connector]):
+            g_connector_streamer.submit(name, connector, value)
+
+# Effects
+
+EFFECT_FADE = 'Fade Brightness'
+EFFECT_CROSSFADE = 'Crossfade Color'
+EFFECT_CYCLE = 'Color Cycle'
+EFFECT_BREATHE = 'Breathe'
+EFFECT_STOP = 'Stop'
+
+# Effects that only color lights can run
+COLOR_EFFECTS = {EFFECT_CROSSFADE, EFFECT_CYCLE}
+
+# Effects that repeat every `duration` seconds until stopped or replaced
+LOOPED_EFFECTS = {EFFECT_CYCLE, EFFECT_BREATHE}
+
+EFFECT_DEFAULT_RTT = 0.1  # seconds assumed for a light's round trip until one is measured
+
+class Effect:
+    # An effect running on one light. Frames are computed from the elapsed time, so a
+    # light that falls behind jumps ahead instead of replaying every frame it missed.
+    __slots__ = ('device_name', 'kind', 'duration', 'brightness', 'hue', 'saturation',
+                 'start_brightness', 'start_hue', 'start_saturation', 'started_at',
+                 'rtt', 'sent_at', 'next_frame_at', 'in_flight', 'finished', 'last_frame')
+
+    def __init__(self, device_name: str, kind: str, duration: float, brightness: int, hue: int, saturation: int, state: 'DeviceState') -> None:
+        self.device_name = device_name
+        self.kind = kind
+        self.duration = duration
+        self.brightness = brightness
+        self.hue = hue
+        self.saturation = saturation
+        self.start_brightness = state.brightness if state.device_on and state.brightness else 1
+        if state.hue is not None and state.saturation is not None and not state.color_temp:
+            self.start_hue, self.start_saturation = state.hue, state.saturation
+        else:
+            # White light: fade in the saturation of the target color
+            self.start_hue, self.start_saturation = hue, 1
+        self.started_at = asyncio.get_running_loop().time()
+        self.rtt = g_metrics.percentile('request', 'device', device_name, 0.5) or EFFECT_DEFAULT_RTT
+        self.sent_at = 0.0
+        self.next_frame_at = self.started_at
+        self.in_flight = False
+        self.finished = False
+        self.last_frame: Optional[Dict[str, Any]] = None
+
+    def frame(self, now: float) -> Dict[str, Any]:
+        # Device state changes of the frame at `now`, sets `finished` on the last one
+        progress = (now - self.started_at) / self.duration
+        if self.kind not in LOOPED_EFFECTS:
+            self.finished = progress >= 1.0
+            progress = min(progress, 1.0)
+
+        if self.kind == EFFECT_FADE:
+            return {'device_on': True, 'brightness': round(self.start_brightness + (self.brightness - self.start_brightness) * progress)}
+        if self.kind == EFFECT_BREATHE:
+            # Starts at full brightness, dims down to 1 half way and comes back
+            return {'device_on': True, 'brightness': round(1 + (self.brightness - 1) * (1 + math.cos(2 * math.pi * progress)) / 2)}
+        if self.kind == EFFECT_CROSSFADE:
+            # Turns the short way round the color wheel
+            delta = (self.hue - self.start_hue + 180) % 360 - 180
+            hue = round(self.start_hue + delta * progress) % 360
+            saturation = round(self.start_saturation + (self.saturation - self.start_saturation) * progress)
+        else:
+            hue = round(self.hue + 360 * progress) % 360
+            saturation = self.saturation
+        return {'device_on': True, 'hue': hue, 'saturation': max(1, saturation), 'color_temp': 0}
+
+class EffectScheduler:
+    # Runs every effect from a single task on the Tapo event loop. A light gets its next
+    # frame once the previous one was answered, at most `effect_max_fps` times a second,
+    # so each light runs at the frame rate its round-trip time allows and frames a slow
+    # light can't keep up with are skipped. Frames go through the device mailbox, any
+    # other command posted to it cancels the effect.
+
+    def __init__(self) -> None:
+        self._effects: Dict[str, Effect] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def is_running(self, device_name: str) -> bool:
+        return device_name in self._effects
+
+    def start(self, effect: Effect) -> None:
+        # Must be called on the Tapo event loop
+        self.cancel(effect.device_name)
+        self._effects[effect.device_name] = effect
+        g_log.debug(f'Effect: d> {effect.device_name} {effect.kind} started for {effect.duration}s')
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+
+    def cancel(self, device_name: str) -> None:
+        if (effect := self._effects.pop(device_name, None)) is not None:
+            g_log.debug(f'Effect: d> {device_name} {effect.kind} stopped')
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._effects:
+            self._wakeup.clear()
+            now = loop.time()
+            for effect in list(self._effects.values()):
+                if not effect.in_flight and now >= effect.next_frame_at:
+                    self._send_frame(effect, now)
+
+            waiting = [effect.next_frame_at for effect in self._effects.values() if not effect.in_flight]
+            try:
+                # Woken early when a frame is answered or an effect starts
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, min(waiting) - loop.time()) if waiting else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def _send_frame(self, effect: Effect, now: float) -> None:
+        device = g_device_list.get(effect.device_name)
+        if device is None:
+            self.cancel(effect.device_name)
+            return
+
+        min_interval = 1.0 / max(g_options['effect_max_fps'], 0.1)
+        changes = effect.frame(now)
+        if changes == effect.last_frame and not effect.finished:
+            # Nothing visible changed since the last frame, no need to bother the light
+            effect.next_frame_at = now + min_interval
+            return
+        if effect.sent_at:
+            g_metrics.effect_frames_skipped += max(0, int((now - effect.sent_at) / min_interval) - 1)
+        g_metrics.effect_frames += 1
+
+        effect.last_frame = changes
+        effect.sent_at = now
+        effect.in_flight = True
+        done = asyncio.get_running_loop().create_future()
+        done.add_done_callback(lambda future: self._frame_done(effect, future.result()))
+        device.mailbox.post(DeviceCommand(TP_PLUGIN_ACTIONS['Effect']['id'], EFFECT_FRAME_ACTION, changes, done))
+
+    def _frame_done(self, effect: Effect, ok: bool) -> None:
+        rtt = asyncio.get_running_loop().time() - effect.sent_at
+        effect.rtt = 0.7 * effect.rtt + 0.3 * rtt
+        effect.in_flight = False
+        effect.next_frame_at = effect.sent_at + max(1.0 / max(g_options['effect_max_fps'], 0.1), effect.rtt)
+        if (effect.finished or not ok) and self._effects.get(effect.device_name) is effect:
+            del self._effects[effect.device_name]
+            g_log.debug(f'Effect: d> {effect.device_name} {effect.kind} {"done" if ok else "failed"}, rtt {effect.rtt * 1000:.0f}ms')
+        self._wakeup.set()
+
+g_effect_scheduler = EffectScheduler()
+
+def start_effects(target: str, kind: str, duration: float, brightness: int, hue: int, saturation: int) -> None:
+    # Must be called on the Tapo event loop, where config reloads run, so group members
+    # are resolved against the current config
+    if (device := g_device_list.get(target)) is not None:
+        devices = [device]
+    else:
+        # Like other group actions, only members supporting effects take part
+        devices = [member for name in g_group_list.get(target, []) if (member := g_device_list.get(name)) and member.supports('Effect')]
+    for device in devices:
+        name = device.name
+        if not device.supports('Effect'):
+            # Plugs have no brightness, frames would only fail and slow the plug down
+            g_log.debug(f'Effect: d> {name} does not support effects')
+        elif kind == EFFECT_STOP:
+            g_effect_scheduler.cancel(name)
+        elif kind in COLOR_EFFECTS and not device.device_type.color:
+            g_log.debug(f'Effect: d> {name} does not support {kind}')
+        else:
+            g_effect_scheduler.start(Effect(name, kind, duration, brightness, hue, saturation, device.state))
 
 # Actions
 
 ## Action definitions
 
-@async_to_sync
-async def perform_action(aid:str, action_data:list) -> None:
-    action = aid.split('.')[-1]
-    device_name = TPClient.getActionDataValue(action_data, TP_PLUGIN_ACTIONS[action]['data']['device_list']['id'])
-    light = g_device_list.get(device_name)['light']
+def perform_action(aid: str, action: str, values: ActionValues) -> None:
+    device_name = values['device_list']
+    device = g_device_list.get(device_name)
 
-    if not light:
-        g_log.debug(f'Action: {aid} | l> Light not found!')
+    if device:
+        g_tapo_loop.call_soon(device.mailbox.post, DeviceCommand(aid, action, values))
+    elif device_name in g_group_list and action in GROUP_ACTIONS:
+        perform_group_action(device_name, aid, action, values)
+    else:
+        g_log.debug(f'Action: {aid} | d> {device_name} Device not found!')
         return
-    
-    action_func = TP_PLUGIN_ACTION_MAP.get(aid)
+
+    g_poller.notify_action()
+
+@run_on_tapo_loop
+async def perform_group_action(group_name: str, aid: str, action: str, values: ActionValues) -> None:
+    members = [member for member in g_group_list.get(group_name, [])
+               if member in g_device_list and g_device_list[member].supports(action)]
+
+    failed = await fan_out_command(members, aid, action, values)
+    if failed:
+        g_log.warning(f'Action: {aid} | g> {group_name} failed for: {failed}')
+    publish_group_states(group_name, failed)
+
+async def fan_out_command(device_names: List[str], aid: str, action: str, values: ActionValues) -> List[str]:
+    # Posts the command to every device at once, each device mailbox runs it concurrently
+    # while the shared semaphore bounds how many talk to their light at a time.
+    # Returns the names of the devices the command failed for.
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(max(1, g_options['group_concurrency']))
+    pending: Dict[str, asyncio.Future] = {}
+
+    for name in device_names:
+        pending[name] = loop.create_future()
+        g_device_list[name].mailbox.post(DeviceCommand(aid, action, values, pending[name], limit))
+
+    results = await asyncio.gather(*pending.values())
+    failed = [name for name, ok in zip(pending, results) if not ok]
+    g_log.debug(f'Action: {aid} | {len(pending) - len(failed)}/{len(pending)} devices OK')
+    return failed
+
+def perform_effect_action(aid: str, values: ActionValues) -> None:
+    target, kind, brightness = values['device_list'], values['effect'], values['bright']
+    duration = max(0.1, values['duration'])
+    hue, saturation = values['rgb']
+
+    if target not in g_device_list and target not in g_group_list:
+        g_log.debug(f'Action: {aid} | d> {target} Device not found!')
+        return
+
+    g_tapo_loop.call_soon(start_effects, target, kind, duration, brightness, hue, saturation)
+    g_poller.notify_action()
+
+def perform_connector_change(connector: str, values: ActionValues, value: int) -> None:
+    target = values['device_list']
+
+    if target not in g_device_list and target not in g_group_list:
+        g_log.debug(f'Connector: {connector} | d> {target} Device not found!')
+        return
+
+    g_tapo_loop.call_soon(start_connector_stream, target, connector, min(100, max(0, value)))
+    g_poller.notify_action()
+
+def perform_scene_action(aid: str, action: str, values: ActionValues) -> None:
+    scene_name = (values['scene'] or '').strip()
+
+    if not scene_name:
+        g_log.debug(f'Action: {aid} | Scene name is empty!')
+        return
+
+    if action == 'SaveScene':
+        save_scene(scene_name)
+    else:
+        recall_scene(scene_name, aid, values)
+        g_poller.notify_action()
+
+async def execute_command(device_name: str, command: 'DeviceCommand') -> bool:
+    device = g_device_list.get(device_name)
+    target = command.target()
+
+    if device and target and g_options['skip_matching_commands'] and device.state.is_fresh(g_options['state_ttl']) and device.state.matches(target):
+        # The light already shows what the command asks for
+        g_metrics.requests_skipped += 1
+        device.desired.settle(target)
+        g_log.debug(f'Action: {command.aid} | d> {device_name} already matches, skipped')
+        return True
+
+    if device and not device.breaker.allow_request():
+        # Fail fast while the light is known dead, the reconnect probes it in the background
+        g_log.debug(f'Action: {command.aid} | d> {device_name} circuit {device.breaker.state}, skipped')
+        defer_changes(device, target)
+        return False
+
+    light = await device.connection.get_light() if device else None
+
+    if not light:
+        g_log.debug(f'Action: {command.aid} | l> Light not found!')
+        if device:
+            defer_changes(device, target)
+        return False
+
+    action_func = INTERNAL_ACTION_MAP.get(command.action) or TP_PLUGIN_ACTION_MAP.get(command.aid)
     if (action_func):
-        await action_func(device_name, light, action_data)
+        g_metrics.observe('queue_wait', time.perf_counter() - command.created_at, command.action, device_name)
+        try:
+            async with g_request_scheduler.slot(device_name, command_priority(command)):
+                with timed('request', command.action, device_name):
+                    await asyncio.wait_for(action_func(device_name, light, command.values), g_options['request_timeout'])
+            device.breaker.record_success()
+            if target:
+                device.desired.settle(target)
+            g_metrics.observe('action', time.perf_counter() - command.created_at, command.action, device_name)
+            g_metrics.completed += 1
+            return True
+        except Exception as e:
+            device.state.invalidate()
+            device.breaker.record_failure()
+            device.connection.reset()
+            publish_device_states(device, reachable=False)
+            defer_changes(device, target)
+            g_log.warning(f'Action: {command.aid} | d> {device_name} failed: {repr(e)}')
     else:
-        g_log.warning(f'Got unknown action ID: {aid}')
+        g_log.warning(f'Got unknown action ID: {command.aid}')
+    return False
 
-async def on_off_action(device_name: str, light: Optional[Any], action_data: list) -> None:
-    on_off = TPClient.getActionDataValue(action_data, TP_PLUGIN_ACTIONS['On_Off']['data']['on_off']['id'])
+async def on_off_action(device_name: str, light: Optional[Any], values: ActionValues) -> None:
+    on_off = values['on_off']
 
-    g_log.debug(f'Action: on_off | a> {on_off} d> {device_name} l> {repr(light)}')
+    if debug_enabled():
+        g_log.debug(f'Action: on_off | a> {on_off} d> {device_name} l> {repr(light)}')
 
     if (on_off == 'ON'):
         await light.on()
     else:
         await light.off()
+    update_device_state(device_name, device_on=(on_off == 'ON'))
 
-async def toggle_action(device_name: str, light: Optional[Any], action_data: list) -> None:
-    g_log.debug(f'Action: toggle | d> {device_name} l> {repr(light)}')
+async def toggle_action(device_name: str, light: Optional[Any], values: ActionValues) -> None:
+    if debug_enabled():
+        g_log.debug(f'Action: toggle | d> {device_name} l> {repr(light)}')
     
-    device_info = await light.get_device_info()
-    g_log.debug(f'Action: toggle | device_info: {repr(device_info)}')
+    device_on = (await get_device_state(g_device_list[device_name])).device_on
+    g_log.debug(f'Action: toggle | device_on: {device_on}')
 
-    if (device_info.device_on):
+    if (device_on):
         await light.off()
     else:
         await light.on()
+    update_device_state(device_name, device_on=not device_on)
 
-async def bright_action(device_name: str, light: Optional[Any], action_data: list) -> None:
-    brightness = TPClient.getActionDataValue(action_data, TP_PLUGIN_ACTIONS['Bright']['data']['bright']['id'])
+async def bright_action(device_name: str, light: Optional[Any], values: ActionValues) -> None:
+    brightness = values['bright']
     
-    g_log.debug(f'Action brightness | d> {device_name} b> {brightness}% l> {repr(light)}')
+    if debug_enabled():
+        g_log.debug(f'Action brightness | d> {device_name} b> {brightness}% l> {repr(light)}')
 
-    await light.set_brightness(int(brightness))
+    await light.set_brightness(brightness)
+    update_device_state(device_name, device_on=True, brightness=brightness)
 
-async def rgb_action(device_name: str, light: Optional[Any], action_data: list) -> None:
-    rgb = TPClient.getActionDataValue(action_data, TP_PLUGIN_ACTIONS['RGB']['data']['rgb']['id'])
+async def rgb_action(device_name: str, light: Optional[Any], values: ActionValues) -> None:
+    hue, saturation = values['rgb']
 
-    hue, saturation = hex_to_hue_saturation(rgb)
-    g_log.debug(f'Action rgb | d> {device_name} r> {rgb} h> {hue} s> {saturation} l> {repr(light)}')
+    if debug_enabled():
+        g_log.debug(f'Action rgb | d> {device_name} h> {hue} s> {saturation} l> {repr(light)}')
 
     await light.set_hue_saturation(hue, saturation)
+    update_device_state(device_name, device_on=True, hue=hue, saturation=saturation, color_temp=0)
 
-async def color_temperature_action(device_name: str, light: Optional[Any], action_data: list) -> None:
-    temperature = TPClient.getActionDataValue(action_data, TP_PLUGIN_ACTIONS['ColorTemperature']['data']['temperature']['id'])
+async def color_temperature_action(device_name: str, light: Optional[Any], values: ActionValues) -> None:
+    temperature = values['temperature']
 
-    g_log.debug(f'Action color_temperature | d> {device_name} t> {temperature} l> {repr(light)}')
+    if debug_enabled():
+        g_log.debug(f'Action color_temperature | d> {device_name} t> {temperature} l> {repr(light)}')
 
-    await light.set_color_temperature(int(temperature))
+    await light.set_color_temperature(temperature)
+    update_device_state(device_name, device_on=True, color_temp=temperature)
 
-async def rgb_bright_action(device_name: str, light: Optional[Any], action_data: list) -> None:
-    rgb = TPClient.getActionDataValue(action_data, TP_PLUGIN_ACTIONS['RGB_Bright']['data']['rgb']['id'])
-    brightness = TPClient.getActionDataValue(action_data, TP_PLUGIN_ACTIONS['RGB_Bright']['data']['bright']['id'])
+async def rgb_bright_action(device_name: str, light: Optional[Any], values: ActionValues) -> None:
+    hue, saturation = values['rgb']
+    brightness = values['bright']
 
-    hue, saturation = hex_to_hue_saturation(rgb)
-    g_log.debug(f'Action rgb_bright | d> {device_name} r> {rgb} b> {brightness} h> {hue} s> {saturation} l> {repr(light)}')
+    if debug_enabled():
+        g_log.debug(f'Action rgb_bright | d> {device_name} b> {brightness} h> {hue} s> {saturation} l> {repr(light)}')
 
-    await light.set().brightness(int(brightness)).hue_saturation(hue, saturation).send(light)
+    await light.set().brightness(brightness).hue_saturation(hue, saturation).send(light)
+    update_device_state(device_name, device_on=True, brightness=brightness, hue=hue, saturation=saturation, color_temp=0)
 
+async def fused_action(device_name: str, light: Optional[Any], changes: Dict[str, Any]) -> None:
+    if debug_enabled():
+        g_log.debug(f'Action fused | d> {device_name} c> {changes} l> {repr(light)}')
+
+    params = light.set().on()
+    if 'brightness' in changes:
+        params = params.brightness(changes['brightness'])
+    if changes.get('color_temp'):
+        params = params.color_temperature(changes['color_temp'])
+    elif 'hue' in changes:
+        params = params.hue_saturation(changes['hue'], changes['saturation'])
+    await params.send(light)
+    update_device_state(device_name, **changes)
+
+async def set_state_action(device_name: str, light: Optional[Any], changes: Dict[str, Any]) -> None:
+    if 'hue' in changes or changes.get('color_temp'):
+        await fused_action(device_name, light, changes)
+    else:
+        # Brightness only changes also work on lights without the `set()` builder
+        await light.set_brightness(changes['brightness'])
+        update_device_state(device_name, **changes)
+
+async def reconcile_action(device_name: str, light: Optional[Any], values: Dict[str, Any]) -> None:
+    # Sends what is still pending when the command runs, commands queued before it
+    # may already have delivered or superseded part of it
+    device = g_device_list[device_name]
+    changes = device.desired.diff(device.state, device.state.is_fresh(g_options['state_ttl']))
+    if debug_enabled():
+        g_log.debug(f'Action reconcile | d> {device_name} c> {changes} l> {repr(light)}')
+
+    if changes.get('device_on') is False:
+        await light.off()
+        update_device_state(device_name, device_on=False)
+    elif 'brightness' in changes or 'hue' in changes or changes.get('color_temp'):
+        await set_state_action(device_name, light, changes)
+    elif changes:
+        await light.on()
+        update_device_state(device_name, device_on=True)
+    if changes:
+        g_metrics.reconciles += 1
+    device.desired.clear()
+
+async def recall_scene_action(device_name: str, light: Optional[Any], values: ActionValues) -> None:
+    scene_name = (values['scene'] or '').strip()
+    entry = g_scene_list.get(scene_name, {}).get(device_name)
+
+    if debug_enabled():
+        g_log.debug(f'Action recall_scene | d> {device_name} s> {scene_name} e> {entry} l> {repr(light)}')
+
+    if entry is None:
+        return
+    if not entry['on']:
+        await light.off()
+        update_device_state(device_name, device_on=False)
+        return
+
+    changes: Dict[str, Any] = {'device_on': True}
+    if (brightness := entry.get('bright')):
+        changes['brightness'] = brightness
+    if g_device_list[device_name].device_type.color:
+        # A single request carrying the power, brightness and color mode of the light
+        params = light.set().on()
+        if brightness:
+            params = params.brightness(brightness)
+        if entry.get('temp'):
+            params = params.color_temperature(entry['temp'])
+            changes['color_temp'] = entry['temp']
+        elif entry.get('hue') and entry.get('sat'):
+            params = params.hue_saturation(entry['hue'], entry['sat'])
+            changes.update(hue=entry['hue'], saturation=entry['sat'], color_temp=0)
+        await params.send(light)
+    elif brightness:
+        await light.set_brightness(brightness)
+    else:
+        await light.on()
+    update_device_state(device_name, **changes)
+
+def hue_saturation_to_hex(hue: int, saturation: int) -> str:
+    r, g, b = colorsys.hsv_to_rgb(hue / 360.0, saturation / 100.0, 1.0)
+
+    return f'#{int(r * 255):02X}{int(g * 255):02X}{int(b * 255):02X}FF'
+
+# Decks reuse a handful of colors, so conversions are cached
+@lru_cache(maxsize=COLOR_CACHE_SIZE)
 def hex_to_hue_saturation(hex_color: str) -> Tuple[int, int]:
     hex_color = hex_color.lstrip('#')
     r, g, b, a = int(hex_color[0:2], 16), int(hex_color[2:4], 16), int(hex_color[4:6], 16), int(hex_color[6:8], 16)
@@ -487,6 +3292,50 @@ def hex_to_hue_saturation(hex_color: str) -> Tuple[int, int]:
 
     return hue, saturation
 
+## Action decoders
+
+class ActionDecoder:
+    # Turns the data list of one TP action or connector into `ActionValues` in a single
+    # pass. Compiled once from the definition: numbers are clamped to their range,
+    # colors become (hue, saturation), fixed choices are checked and missing values take
+    # the definition default. `decode` raises `ValueError` on a value it can't convert.
+    __slots__ = ('action', '_fields', '_defaults')
+
+    def __init__(self, action: str, definition: Dict[str, Any]) -> None:
+        self.action = action
+        self._fields: Dict[str, Tuple[str, Callable[[Any], Any]]] = {}  # data ID -> data name and converter
+        self._defaults: ActionValues = {}
+        for name, data in definition['data'].items():
+            convert = data_converter(data)
+            self._fields[data['id']] = (name, convert)
+            self._defaults[name] = convert(data['default']) if data.get('default') not in (None, '') else None
+
+    def decode(self, action_data: list) -> ActionValues:
+        values = self._defaults.copy()
+        fields = self._fields
+        for item in action_data:
+            if (field := fields.get(item.get('id'))) and (value := item.get('value')) not in (None, ''):
+                values[field[0]] = field[1](value)
+        return values
+
+def data_converter(data: Dict[str, Any]) -> Callable[[Any], Any]:
+    if data['type'] == 'number':
+        low, high = data.get('minValue', -math.inf), data.get('maxValue', math.inf)
+        integer = not data.get('allowDecimals', True)
+        def convert_number(value: Any) -> Any:
+            number = min(high, max(low, float(value)))
+            return round(number) if integer else number
+        return convert_number
+    if data['type'] == 'color':
+        return lambda value: hex_to_hue_saturation(str(value))
+    if data['type'] == 'choice' and (choices := frozenset(data['valueChoices'])):
+        def convert_choice(value: Any) -> str:
+            if value not in choices:
+                raise ValueError(f'{value!r} is not one of {sorted(choices)}')
+            return value
+        return convert_choice
+    return str
+
 ## Action map
 
 TP_PLUGIN_ACTION_MAP = {
@@ -495,7 +3344,25 @@ TP_PLUGIN_ACTION_MAP = {
     TP_PLUGIN_ACTIONS['Bright']['id']: bright_action,
     TP_PLUGIN_ACTIONS['RGB']['id']: rgb_action,
     TP_PLUGIN_ACTIONS['ColorTemperature']['id']: color_temperature_action,
-    TP_PLUGIN_ACTIONS['RGB_Bright']['id']: rgb_bright_action
+    TP_PLUGIN_ACTIONS['RGB_Bright']['id']: rgb_bright_action,
+    TP_PLUGIN_ACTIONS['RecallScene']['id']: recall_scene_action
+}
+
+ACTION_DECODERS = {definition['id']: ActionDecoder(action, definition) for action, definition in TP_PLUGIN_ACTIONS.items()}
+CONNECTOR_DECODERS = {definition['id']: ActionDecoder(connector, definition) for connector, definition in TP_PLUGIN_CONNECTORS.items()}
+
+# Internal commands created by the plugin rather than by a TP action
+INTERNAL_ACTION_MAP = {
+    FUSED_ACTION: fused_action,
+    EFFECT_FRAME_ACTION: set_state_action,
+    CONNECTOR_ACTION: set_state_action,
+    RECONCILE_ACTION: reconcile_action
+}
+
+# Scene actions don't target a device, they are dispatched by `perform_scene_action`
+TP_PLUGIN_SCENE_ACTIONS = {
+    TP_PLUGIN_ACTIONS['SaveScene']['id'],
+    TP_PLUGIN_ACTIONS['RecallScene']['id']
 }
 
 # TP Client event handler callbacks
@@ -504,6 +3371,7 @@ TP_PLUGIN_ACTION_MAP = {
 @TPClient.on(TP.TYPES.onConnect)
 def on_connect(data: dict) -> None:
     g_log.info(f'Connected to TP v{data.get('tpVersionString', '?')}, plugin v{data.get('pluginVersion', '?')}.')
+    g_startup_timeline.mark('tp connected')
     g_log.debug(f'Connection: {data}')
     if settings := data.get('settings'):
         handle_settings(settings, True)
@@ -518,33 +3386,72 @@ def on_setting_update(data: dict) -> None:
 ## Action handler
 @TPClient.on(TP.TYPES.onAction)
 def on_action(data: dict) -> None:
-    g_log.debug(f'Action {data}')
+    if debug_enabled():
+        g_log.debug(f'Action {data}')
     
     action_data = data.get('data')
     aid = data.get('actionId')
 
     if not action_data or not aid:
         return
-    
-    if aid in TP_PLUGIN_ACTION_MAP:
-        perform_action(aid, action_data)
-    else:
+    if not (decoder := ACTION_DECODERS.get(aid)):
         g_log.warning('Got unknown action ID: ' + aid)
+        return
+
+    action = decoder.action
+    try:
+        with timed('parse', action):
+            values = decoder.decode(action_data)
+    except (ValueError, TypeError) as e:
+        g_log.warning(f'Action: {aid} | invalid data: {e}')
+        return
+
+    if aid in TP_PLUGIN_SCENE_ACTIONS:
+        perform_scene_action(aid, action, values)
+    elif action == 'Effect':
+        perform_effect_action(aid, values)
+    else:
+        with timed('dispatch', action):
+            perform_action(aid, action, values)
+
+## Connector handler
+@TPClient.on(TP.TYPES.onConnectorChange)
+def on_connector_change(data: dict) -> None:
+    if debug_enabled():
+        g_log.debug(f'Connector {data}')
+
+    connector_id = data.get('connectorId')
+    decoder = CONNECTOR_DECODERS.get(connector_id)
+    if not decoder or not data.get('data'):
+        g_log.warning(f'Got unknown connector ID: {connector_id}')
+        return
+    connector = decoder.action
+    with timed('dispatch', connector):
+        perform_connector_change(connector, decoder.decode(data['data']), int(data.get('value', 0)))
 
 ## Shutdown handler
 @TPClient.on(TP.TYPES.onShutdown)
 def onShutdown(data: dict) -> None:
     g_log.info('Received shutdown event from TP Client.')
+    g_log.info(f'Coalesced {g_coalesced_commands} superseded device commands.')
+    g_log.info(f'Fused {g_fused_commands} device commands into {g_fused_requests} requests.')
+    # Queued before the stop so the caches are saved on the Tapo loop before it ends
+    g_tapo_loop.call_soon(g_startup_cache.save)
+    g_tapo_loop.call_soon(g_discovery.flush)
+    g_tapo_loop.stop()
 
 ## Error handler
 @TPClient.on(TP.TYPES.onError)
 def onError(exc: dict) -> None:
     g_log.warning(f'Error in TP Client event handler: {repr(exc)}')
 
+g_startup_timeline.mark('module loaded')
+
 # main
 
 def main() -> int:
     global TPClient, g_log
+    from argparse import ArgumentParser
     ret = 0  # sys.exit() value
     
     logFile = f'./{PLUGIN_ID}.log'
@@ -581,9 +3488,12 @@ def main() -> int:
     TPClient.setLogLevel(logLevel)
 
     g_log.info(f'Starting {TP_PLUGIN_INFO['name']} v{__version__} on {sys.platform}.')
+    g_startup_timeline.start_logging()
 
     # Let's GO !!!!
     try:
+        g_tapo_loop.start()
+        g_tapo_loop.call_soon(preload_modules)
         TPClient.connect()
         g_log.info('TP Client closed.')
     except KeyboardInterrupt:
@@ -594,6 +3504,7 @@ def main() -> int:
         ret = -1
     finally:
         TPClient.disconnect()
+        g_tapo_loop.stop()
     
     del TPClient
 
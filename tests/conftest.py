@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# The plugin is a single module next to its build script, not an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugin'))
+
+import TPLinkTapoPlugin as plugin
+
+
+@pytest.fixture(autouse=True)
+def default_options(monkeypatch):
+    # Every test starts from the default options and without per-type rate limits
+    monkeypatch.setattr(plugin, 'g_options', dict(plugin.DEFAULT_OPTIONS))
+    monkeypatch.setattr(plugin, 'g_rate_limits', {})
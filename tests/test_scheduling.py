@@ -0,0 +1,212 @@
+import asyncio
+import math
+
+import pytest
+
+import TPLinkTapoPlugin as plugin
+
+
+# Rate limiter
+
+def test_burst_then_rate():
+    plugin.g_rate_limits['L510'] = {'rate_limit_max': 10.0, 'rate_limit_burst': 2.0}
+    limiter = plugin.DeviceRateLimiter('Light', 'L510')
+    assert limiter.reserve() == 0.0
+    assert limiter.reserve() == 0.0
+    assert limiter.reserve() == pytest.approx(0.1, abs=0.01)
+
+
+@pytest.mark.parametrize('limits', [
+    {'rate_limit_max': 0.0},
+    {'rate_limit_max': 0.0, 'rate_limit_min': 0.0},
+    {'rate_limit_max': 0.0, 'rate_limit_min': 0.0, 'rate_limit_burst': 0.0},
+])
+def test_zero_rate_still_lets_requests_through(limits):
+    plugin.g_rate_limits['L510'] = limits
+    limiter = plugin.DeviceRateLimiter('Light', 'L510')
+    delays = [limiter.reserve() for _ in range(15)]
+    assert all(math.isfinite(delay) and delay >= 0 for delay in delays)
+    assert limiter.rate == plugin.RATE_LIMIT_LOWEST
+    # A burst below 1 still lets the first request through right away
+    assert delays[0] == 0.0
+
+
+def test_acquire_waits_once_the_burst_is_used():
+    plugin.g_rate_limits['L510'] = {'rate_limit_max': 20.0, 'rate_limit_burst': 1.0}
+    limiter = plugin.DeviceRateLimiter('Light', 'L510')
+    delayed = plugin.g_metrics.requests_delayed
+
+    async def acquire_twice():
+        started = asyncio.get_running_loop().time()
+        await limiter.acquire()
+        await limiter.acquire()
+        return asyncio.get_running_loop().time() - started
+
+    assert asyncio.run(acquire_twice()) >= 0.04
+    assert limiter.delayed == 1
+    assert plugin.g_metrics.requests_delayed == delayed + 1
+
+
+def test_rate_stays_within_its_limits():
+    plugin.g_rate_limits['L510'] = {'rate_limit_max': 4.0, 'rate_limit_min': 1.0}
+    limiter = plugin.DeviceRateLimiter('Light', 'L510')
+    for _ in range(10):
+        limiter.record_failure()
+    assert limiter.rate == 1.0
+    limiter.record_success(limiter.limit('rate_limit_latency') + 1)
+    assert limiter.rate == 1.0
+    for _ in range(20):
+        limiter.record_success(0.0)
+    assert limiter.rate == 4.0
+
+
+def test_invalid_rate_limits_fall_back():
+    options = {**plugin.DEFAULT_OPTIONS, **plugin.read_config_options({'rate_limit_max': 0, 'rate_limit_burst': 0.5})}
+    assert options['rate_limit_max'] == plugin.DEFAULT_OPTIONS['rate_limit_max']
+    assert options['rate_limit_burst'] == plugin.DEFAULT_OPTIONS['rate_limit_burst']
+
+    rate_limits = plugin.read_config_rate_limits({
+        'L510': {'max_rate': 0, 'burst': 0, 'latency': -1},
+        'L530': {'min_rate': 5, 'max_rate': 3},
+        'L630': {'max_rate': 4, 'burst': 2},
+    }, options)
+    assert rate_limits == {'L510': {}, 'L530': {}, 'L630': {'rate_limit_max': 4.0, 'rate_limit_burst': 2.0}}
+
+
+# Mailbox
+
+@pytest.fixture
+def executed(monkeypatch):
+    # Commands the mailboxes send to their light, instead of talking to a light
+    commands = []
+
+    async def execute_command(device_name, command):
+        commands.append((command.action, dict(command.values)))
+        return True
+
+    monkeypatch.setattr(plugin, 'execute_command', execute_command)
+    return commands
+
+
+def post_all(mailbox, commands):
+    # Posts the commands back to back, before the worker runs, and waits until they are done
+    async def run():
+        loop = asyncio.get_running_loop()
+        futures = []
+        for action, values in commands:
+            futures.append(loop.create_future())
+            mailbox.post(plugin.DeviceCommand('aid', action, values, futures[-1]))
+        return await asyncio.gather(*futures)
+
+    return asyncio.run(run())
+
+
+def test_latest_wins(executed):
+    mailbox = plugin.DeviceMailbox('Light')
+    results = post_all(mailbox, [('Bright', {'bright': 10}), ('Bright', {'bright': 20}), ('Bright', {'bright': 30})])
+    assert executed == [('Bright', {'bright': 30})]
+    assert mailbox.coalesced == 2
+    # Superseded commands report what the newer one delivered
+    assert results == [True, True, True]
+
+
+def test_latest_wins_keeps_power_order(executed):
+    mailbox = plugin.DeviceMailbox('Light')
+    post_all(mailbox, [('Bright', {'bright': 10}), ('On_Off', {'on_off': 'OFF'}), ('Bright', {'bright': 20})])
+    assert [action for action, _ in executed] == ['Bright', 'On_Off', 'Bright']
+    assert mailbox.coalesced == 0
+
+
+def test_fusion(executed):
+    mailbox = plugin.DeviceMailbox('Light', fusable=True)
+    post_all(mailbox, [('On_Off', {'on_off': 'ON'}), ('Bright', {'bright': 40}), ('RGB', {'rgb': (120, 50)})])
+    assert executed == [(plugin.FUSED_ACTION, {'device_on': True, 'brightness': 40, 'hue': 120, 'saturation': 50, 'color_temp': 0})]
+    assert mailbox.fused == 3
+
+
+def test_fusion_temperature_after_color(executed):
+    mailbox = plugin.DeviceMailbox('Light', fusable=True)
+    post_all(mailbox, [('RGB', {'rgb': (120, 50)}), ('ColorTemperature', {'temperature': 4000})])
+    assert executed == [(plugin.FUSED_ACTION, {'device_on': True, 'color_temp': 4000})]
+
+
+def test_fusion_stops_at_power_off(executed):
+    mailbox = plugin.DeviceMailbox('Light', fusable=True)
+    post_all(mailbox, [('Bright', {'bright': 40}), ('On_Off', {'on_off': 'OFF'}), ('Bright', {'bright': 60})])
+    assert [action for action, _ in executed] == ['Bright', 'On_Off', 'Bright']
+
+
+# Priority gate
+
+def test_priority_gate_order():
+    async def run():
+        gate = plugin.PriorityGate(lambda: 1)
+        order = []
+
+        async def holder(name, priority):
+            await gate.acquire(priority)
+            order.append(name)
+            gate.release()
+
+        await gate.acquire(plugin.PRIORITY_BACKGROUND)
+        tasks = [asyncio.create_task(holder(name, priority)) for name, priority in [
+            ('poll', plugin.PRIORITY_BACKGROUND), ('tap', plugin.PRIORITY_POWER), ('frame', plugin.PRIORITY_EFFECT),
+            ('slider', plugin.PRIORITY_SET), ('second tap', plugin.PRIORITY_POWER)]]
+        await asyncio.sleep(0)
+        assert not order
+        gate.release()
+        await asyncio.gather(*tasks)
+        assert gate.idle()
+        return order
+
+    assert asyncio.run(run()) == ['tap', 'second tap', 'slider', 'frame', 'poll']
+
+
+def test_priority_gate_capacity():
+    async def run():
+        gate = plugin.PriorityGate(lambda: 2)
+        await gate.acquire(plugin.PRIORITY_SET)
+        await gate.acquire(plugin.PRIORITY_SET)
+        waiter = asyncio.create_task(gate.acquire(plugin.PRIORITY_POWER))
+        await asyncio.sleep(0)
+        assert not waiter.done() and gate.in_use == 2
+        gate.release()
+        await waiter
+        assert gate.in_use == 2
+
+    asyncio.run(run())
+
+
+def test_priority_gate_cancelled_waiter_passes_its_place():
+    async def run():
+        gate = plugin.PriorityGate(lambda: 1)
+        await gate.acquire(plugin.PRIORITY_SET)
+        cancelled = asyncio.create_task(gate.acquire(plugin.PRIORITY_POWER))
+        waiting = asyncio.create_task(gate.acquire(plugin.PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        gate.release()
+        await waiting
+        assert gate.in_use == 1
+
+    asyncio.run(run())
+
+
+# Breaker
+
+def test_breaker_opens_and_recovers():
+    plugin.g_options['breaker_threshold'] = 2
+    breaker = plugin.DeviceBreaker('Light')
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == plugin.BREAKER_OPEN and not breaker.allow_request()
+    # A failed probe opens it again, a successful one closes it
+    breaker.begin_probe()
+    assert breaker.state == plugin.BREAKER_HALF_OPEN
+    breaker.record_failure()
+    assert breaker.state == plugin.BREAKER_OPEN
+    breaker.begin_probe()
+    breaker.record_success()
+    assert breaker.allow_request() and breaker.failures == 0
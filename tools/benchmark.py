@@ -0,0 +1,409 @@
+# Benchmark for the plugin's action pipeline, without Touch Portal or real lights.
+#
+# Loads the plugin module, replaces the TP connection with a recorder and drives
+# `on_connect`, `on_setting_update` and `on_action` with synthetic or recorded TP
+# message streams against lights from `tapo_simulator.py`. Reports the cold import
+# time of the plugin, startup-to-ready time, action latency percentiles, throughput and peak memory to a JSON file so
+# runs can be compared before a release.
+#
+# Action latency is measured from the `on_action` call until the command reached its
+# light. Commands superseded by a newer one (coalescing) never reach a light on their
+# own, they are reported as a count instead.
+#
+# With `--accounts` the lights are spread over several Tapo accounts, and the open
+# connections and memory the plugin reports per account are added to the results.
+
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import yaml
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugin'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import tapo_simulator as sim
+
+BENCH_GROUP = 'Bench Group'
+
+# Plugin under test
+
+class PluginHarness:
+    # Wraps the plugin module, records what it sends to TP and tracks every device
+    # command from the moment it is created until the mailbox resolves it
+
+    def __init__(self) -> None:
+        import TPLinkTapoPlugin as plugin
+        self.plugin = plugin
+        self.sent: List[Dict[str, Any]] = []
+        self.latencies: Dict[str, List[float]] = {}
+        self.dispatch: Dict[str, List[float]] = {}  # action -> seconds spent in `on_action`
+        self.superseded = 0
+        self._created: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self._posting = False
+
+        plugin.TPClient.send = self.sent.append
+        plugin.TPClient.isConnected = lambda: True
+        plugin.TPClient.setLogLevel(None)
+        self._instrument_commands()
+
+    def _instrument_commands(self) -> None:
+        command_class = self.plugin.DeviceCommand
+        original_init, original_resolve, original_post = command_class.__init__, command_class.resolve, self.plugin.DeviceMailbox.post
+        harness = self
+
+        def init(command, aid, action, *args, **kwargs) -> None:
+            original_init(command, aid, action, *args, **kwargs)
+            if action != harness.plugin.FUSED_ACTION:
+                with harness._lock:
+                    harness._created[id(command)] = (time.perf_counter(), action)
+
+        def resolve(command, result) -> None:
+            original_resolve(command, result)
+            harness._complete(command, superseded=harness._posting)
+
+        def post(mailbox, command) -> None:
+            # Commands resolved while posting are the ones the new command superseded
+            harness._posting = True
+            try:
+                original_post(mailbox, command)
+            finally:
+                harness._posting = False
+
+        command_class.__init__ = init
+        command_class.resolve = resolve
+        self.plugin.DeviceMailbox.post = post
+
+    def _complete(self, command: Any, superseded: bool) -> None:
+        with self._lock:
+            created = self._created.pop(id(command), None)
+        if created is None:
+            return
+        if superseded:
+            self.superseded += 1
+        else:
+            created_at, action = created
+            self.latencies.setdefault(action, []).append(time.perf_counter() - created_at)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._created)
+
+    def reset_metrics(self) -> None:
+        self.latencies = {}
+        self.dispatch = {}
+        self.superseded = 0
+
+    def on_action(self, message: Dict[str, Any]) -> None:
+        started = time.perf_counter()
+        self.plugin.on_action(message)
+        elapsed = time.perf_counter() - started
+        self.dispatch.setdefault(message['actionId'].split('.')[-1], []).append(elapsed)
+
+    def on_connect(self, settings: List[Dict[str, str]]) -> None:
+        self.plugin.on_connect({'tpVersionString': 'benchmark', 'pluginVersion': self.plugin.__version__, 'settings': settings})
+
+    def on_setting_update(self, settings: List[Dict[str, str]]) -> None:
+        self.plugin.on_setting_update({'values': settings})
+
+    def action_message(self, action: str, device: str, **values: Any) -> Dict[str, Any]:
+        definition = self.plugin.TP_PLUGIN_ACTIONS[action]
+        data = [{'id': definition['data']['device_list']['id'], 'value': device}]
+        data += [{'id': definition['data'][key]['id'], 'value': str(value)} for key, value in values.items()]
+        return {'type': 'action', 'actionId': definition['id'], 'data': data}
+
+    def supports(self, device: str, action: str) -> bool:
+        return self.plugin.g_device_list[device].supports(action)
+
+    def connected_devices(self) -> int:
+        return sum(1 for device in list(self.plugin.g_device_list.values()) if device.light)
+
+def settings_message(config_file: str, username: str, password: str) -> List[Dict[str, str]]:
+    return [{'Config File Path': config_file}, {'Username': username}, {'Password': password}]
+
+# Simulated lights
+
+class SimulatorThread:
+    # Runs the simulator on its own event loop so it doesn't share the plugin's
+
+    def __init__(self, simulator: sim.TapoSimulator) -> None:
+        self.simulator = simulator
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='TapoSimulator', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self.simulator.start(), self._loop).result()
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.simulator.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+
+# Metrics
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def latency_summary(values: List[float]) -> Dict[str, Any]:
+    return {
+        'count': len(values),
+        'p50_ms': to_ms(percentile(values, 0.50)),
+        'p95_ms': to_ms(percentile(values, 0.95)),
+        'p99_ms': to_ms(percentile(values, 0.99)),
+        'max_ms': to_ms(max(values) if values else None),
+    }
+
+def to_ms(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value * 1000, 3)
+
+def wait_until(condition: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+def run_scenario(harness: PluginHarness, name: str, drive: Callable[[], int], timeout: float) -> Dict[str, Any]:
+    # Runs `drive` (which returns the number of TP messages it sent) and waits until
+    # every device command it caused has been resolved
+    harness.reset_metrics()
+    tracemalloc.reset_peak()
+    delayed_before = harness.plugin.g_metrics.requests_delayed
+    started = time.perf_counter()
+    messages = drive()
+    drained = wait_until(lambda: harness.pending() == 0, timeout)
+    elapsed = time.perf_counter() - started
+
+    completed = sum(len(values) for values in harness.latencies.values())
+    delayed = harness.plugin.g_metrics.requests_delayed - delayed_before
+    result = {
+        'messages': messages,
+        'commands_completed': completed,
+        'commands_superseded': harness.superseded,
+        'drained': drained,
+        'duration_s': round(elapsed, 3),
+        'throughput_per_s': round(completed / elapsed, 1) if elapsed > 0 else None,
+        'dispatch': latency_summary([value for values in harness.dispatch.values() for value in values]),
+        'dispatch_by_action': {action: latency_summary(values) for action, values in harness.dispatch.items()},
+        'latency': latency_summary([value for values in harness.latencies.values() for value in values]),
+        'latency_by_action': {action: latency_summary(values) for action, values in harness.latencies.items()},
+        'requests_delayed': delayed,
+        'peak_memory_kb': tracemalloc.get_traced_memory()[1] // 1024,
+    }
+    dispatch = ', '.join(f'{action} {summary["p50_ms"]}ms' for action, summary in result['dispatch_by_action'].items())
+    print(f'{name}: {completed} commands in {elapsed:.2f}s, p50 {result["latency"]["p50_ms"]}ms p99 {result["latency"]["p99_ms"]}ms, '
+          f'{delayed} requests delayed by rate limits, dispatch p50 {dispatch}')
+    return result
+
+# Accounts
+
+def account_name(index: int) -> str:
+    # Lights of the first account use the plugin settings
+    return '' if index == 0 else f'Account {index}'
+
+def account_credentials(index: int) -> Tuple[str, str]:
+    return (sim.DEFAULT_USERNAME, sim.DEFAULT_PASSWORD) if index == 0 else (f'account{index}@localhost', sim.DEFAULT_PASSWORD)
+
+def account_report(harness: PluginHarness) -> Dict[str, Dict[str, int]]:
+    async def read() -> Dict[str, Dict[str, int]]:
+        return harness.plugin.g_client_pool.report()
+
+    # Read on the Tapo loop, where the pool lives
+    report = harness.plugin.g_tapo_loop.submit(read()).result(10)
+    for account, entry in report.items():
+        print(f'account {account}: {entry["connections"]}/{entry["lights"]} lights connected, ~{entry["memory_bytes"] // 1024}kB')
+    return report
+
+# Scenarios
+
+def cold_import(harness: PluginHarness) -> Dict[str, Any]:
+    # Imports the plugin in a fresh interpreter, where nothing was loaded by this
+    # benchmark yet, and reports the plugin's own startup timeline
+    code = 'import json, TPLinkTapoPlugin as plugin; print(json.dumps(plugin.g_startup_timeline.phases))'
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(harness.plugin.__file__)),
+                             capture_output=True, text=True, timeout=60)
+    finished = time.perf_counter()
+    if process.returncode != 0:
+        print(f'cold import failed: {process.stderr.strip()}')
+        return {'process_ms': None, 'phases_ms': {}}
+
+    phases = json.loads(process.stdout.strip().splitlines()[-1])
+    result = {
+        'process_ms': to_ms(finished - started),
+        'phases_ms': {phase: round(ms, 3) for phase, ms in phases.items()},
+    }
+    print(f'cold import: {", ".join(f"{phase} {ms:.1f}ms" for phase, ms in phases.items())}, process {result["process_ms"]}ms')
+    return result
+
+def startup(harness: PluginHarness, settings: List[Dict[str, str]], device_count: int, timeout: float) -> Dict[str, Any]:
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    harness.on_connect(settings)
+    configured = wait_until(lambda: len(harness.plugin.g_device_list) == device_count, timeout)
+    configured_at = time.perf_counter()
+    ready = configured and wait_until(lambda: harness.connected_devices() == device_count, timeout)
+    ready_at = time.perf_counter()
+
+    result = {
+        'devices': device_count,
+        'connected': harness.connected_devices(),
+        'config_loaded_ms': to_ms(configured_at - started),
+        'ready_ms': to_ms(ready_at - started) if ready else None,
+        'peak_memory_kb': tracemalloc.get_traced_memory()[1] // 1024,
+    }
+    print(f'startup: {result["connected"]}/{device_count} lights ready in {result["ready_ms"]}ms')
+    return result
+
+def slider_drag(harness: PluginHarness, devices: List[str], steps: int, interval: float) -> Callable[[], int]:
+    # A brightness slider dragged on every dimmable device at once, one TP message per step
+    dimmable = [device for device in devices if harness.supports(device, 'Bright')]
+
+    def drive() -> int:
+        for step in range(steps):
+            for device in dimmable:
+                harness.on_action(harness.action_message('Bright', device, bright=1 + step * 99 // max(1, steps - 1)))
+            time.sleep(interval)
+        return steps * len(dimmable)
+    return drive
+
+def macro_pages(harness: PluginHarness, devices: List[str], pages: int, group: Optional[str]) -> Callable[[], int]:
+    # Multi-action buttons: every page turns lights on, sets color, brightness and
+    # temperature back to back, then switches the whole group off
+    def drive() -> int:
+        messages = 0
+        for _ in range(pages):
+            for device in devices:
+                # Like TP, only send a light the actions its model supports
+                color, dimmable = harness.supports(device, 'RGB'), harness.supports(device, 'Bright')
+                harness.on_action(harness.action_message('On_Off', device, on_off='ON'))
+                if color:
+                    harness.on_action(harness.action_message('RGB', device, rgb=f'#{random.randrange(0x1000000):06X}FF'))
+                if dimmable:
+                    harness.on_action(harness.action_message('Bright', device, bright=random.randint(1, 100)))
+                if color:
+                    harness.on_action(harness.action_message('ColorTemperature', device, temperature=random.choice([2700, 4000, 6500])))
+                messages += 1 + dimmable + 2 * color
+            if group:
+                harness.on_action(harness.action_message('On_Off', group, on_off='OFF'))
+                messages += 1
+        return messages
+    return drive
+
+def replay_trace(harness: PluginHarness, file_path: str, settings: List[Dict[str, str]]) -> Callable[[], int]:
+    # Replays a JSON lines file of TP messages. An optional `t` (seconds since the start
+    # of the trace) keeps the original timing, `settings` messages use the benchmark's
+    # settings unless they bring their own `values`.
+    with open(file_path, 'r') as file:
+        messages = [json.loads(line) for line in file if line.strip()]
+
+    def drive() -> int:
+        started = time.perf_counter()
+        for message in messages:
+            if (delay := message.get('t', 0) - (time.perf_counter() - started)) > 0:
+                time.sleep(delay)
+            if message.get('type') == 'action':
+                harness.on_action(message)
+            elif message.get('type') == 'settings':
+                harness.on_setting_update(message.get('values') or settings)
+        return len(messages)
+    return drive
+
+# main
+
+def main() -> int:
+    parser = ArgumentParser(description='Benchmark the plugin against simulated lights.')
+    parser.add_argument('--devices', type=int, default=30, help='Number of simulated lights (default 30).')
+    parser.add_argument('--models', default='L530,L510', help='Comma separated models to cycle through, e.g. L530,L510,P100 (default L530,L510).')
+    parser.add_argument('--base-port', type=int, default=18000, help='Port of the first simulated light (default 18000).')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds each simulated light adds to a response (default 0.01).')
+    parser.add_argument('--jitter', type=float, default=0.005, help='Random extra seconds per response (default 0.005).')
+    parser.add_argument('--loss', type=float, default=0.0, help='Probability a simulated light drops a request.')
+    parser.add_argument('--handshake-cost', type=float, default=0.05, help='Extra seconds per handshake (default 0.05).')
+    parser.add_argument('--slider-steps', type=int, default=50, help='Slider messages per light (default 50).')
+    parser.add_argument('--slider-interval', type=float, default=0.01, help='Seconds between slider messages (default 0.01).')
+    parser.add_argument('--macro-pages', type=int, default=5, help='Macro pages to run (default 5).')
+    parser.add_argument('--trace', metavar='<file>', help='Also replay a JSON lines trace of TP messages.')
+    parser.add_argument('--accounts', type=int, default=1, help='Tapo accounts the lights are spread over (default 1).')
+    parser.add_argument('--options', metavar='<yaml>', help='Plugin options, as a YAML mapping, to add to the generated config.')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Seconds to wait for a scenario to settle (default 60).')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for synthetic messages (default 1).')
+    parser.add_argument('--output', default='benchmark-results.json', help='Results file (default benchmark-results.json).')
+    opts = parser.parse_args()
+
+    random.seed(opts.seed)
+    tracemalloc.start()
+
+    conditions = sim.NetworkConditions(opts.latency, opts.jitter, opts.loss, opts.handshake_cost)
+    models = [model.strip() for model in opts.models.split(',') if model.strip()]
+    accounts = max(1, opts.accounts)
+    simulator = sim.TapoSimulator([
+        sim.SimulatedLight(f'Sim #{index + 1}', models[index % len(models)], '127.0.0.1', opts.base_port + index, conditions,
+                           account_credentials(index % accounts))
+        for index in range(opts.devices)
+    ])
+    devices = [light.name for light in simulator.lights]
+
+    config = simulator.plugin_config()
+    config['groups'] = {BENCH_GROUP: devices}
+    if accounts > 1:
+        config['accounts'] = {account_name(index): dict(zip(('username', 'password'), account_credentials(index))) for index in range(1, accounts)}
+        for entries in list(config.values()):
+            for entry in entries if isinstance(entries, list) else []:
+                if (index := devices.index(entry['name']) % accounts):
+                    entry['account'] = account_name(index)
+    if opts.options:
+        config['options'] = yaml.safe_load(opts.options)
+
+    harness = PluginHarness()
+    simulator_thread = SimulatorThread(simulator)
+    simulator_thread.start()
+    harness.plugin.g_tapo_loop.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = os.path.join(directory, 'benchmark-config.yaml')
+        with open(config_file, 'w') as file:
+            yaml.safe_dump(config, file, sort_keys=False)
+        settings = settings_message(config_file, sim.DEFAULT_USERNAME, sim.DEFAULT_PASSWORD)
+
+        try:
+            results: Dict[str, Any] = {
+                'plugin_version': harness.plugin.__version__,
+                'python': platform.python_version(),
+                'platform': sys.platform,
+                'parameters': vars(opts),
+                'cold_import': cold_import(harness),
+                'startup': startup(harness, settings, len(devices), opts.timeout),
+            }
+            results['slider'] = run_scenario(harness, 'slider', slider_drag(harness, devices, opts.slider_steps, opts.slider_interval), opts.timeout)
+            results['macro'] = run_scenario(harness, 'macro', macro_pages(harness, devices, opts.macro_pages, BENCH_GROUP), opts.timeout)
+            if opts.trace:
+                results['trace'] = run_scenario(harness, 'trace', replay_trace(harness, opts.trace, settings), opts.timeout)
+            results['accounts'] = account_report(harness)
+            results['simulator'] = simulator.stats()
+        finally:
+            harness.plugin.g_tapo_loop.stop()
+            simulator_thread.stop()
+
+    with open(opts.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results written to {opts.output}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,512 @@
+# Local stand-in for Tapo lights, for testing the plugin without hardware.
+#
+# Every simulated light is a small HTTP server speaking the Tapo KLAP protocol
+# (two step seed handshake, AES encrypted and signed requests) that the `tapo` client
+# library uses, which is enough for `fetch_device`, `get_device_info` and every plugin
+# action. Network conditions (latency, jitter, loss, handshake cost, session expiry)
+# are configurable so production slowdowns can be reproduced on a single PC.
+#
+# KLAP authenticates both sides with a hash of the credentials, so the plugin must use
+# the same username and password as the simulator.
+#
+# Lights listen on `ip:port`. The `tapo` client accepts `ip: 127.0.0.1:18000` in the
+# plugin config, so hundreds of lights can run on one loopback address without
+# needing privileges for port 80.
+#
+# With `--discovery-host` the simulator also answers the UDP discovery probe on port
+# 20002, so the plugin's LAN discovery can be tried on loopback (e.g. lights on
+# 127.0.0.2, 127.0.0.3, ... and `discovery_subnets: 127.0.0.255`). The client keeps
+# one answer per address, so only the first light of each host is discovered.
+
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import secrets
+import struct
+import sys
+import time
+import yaml
+import zlib
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    sys.exit('The simulator needs the "cryptography" package, install it with: pip3 install -r requirements-dev.txt')
+
+DEFAULT_USERNAME = 'simulator@localhost'
+DEFAULT_PASSWORD = 'simulator'
+
+# Simulated models and what they can do
+KIND_PLUG = 'plug'  # on / off only
+KIND_LIGHT = 'light'  # dimmable
+KIND_COLOR = 'color'  # dimmable with color and color temperature
+
+SIMULATED_MODELS = {
+    'L510': KIND_LIGHT,
+    'L520': KIND_LIGHT,
+    'L610': KIND_LIGHT,
+    'L530': KIND_COLOR,
+    'L630': KIND_COLOR,
+    'P100': KIND_PLUG,
+}
+
+# Tapo error codes understood by the `tapo` client
+ERROR_OK = 0
+ERROR_INVALID_REQUEST = -1002
+
+# Tapo discovery: a 16 byte header followed by JSON, on a fixed UDP port
+DISCOVERY_PORT = 20002
+DISCOVERY_HEADER_SIZE = 16
+
+# Network conditions
+
+class NetworkConditions:
+    # Delays and failures applied to every request a simulated light receives
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, loss: float = 0.0,
+                 handshake_cost: float = 0.0, session_ttl: float = 0.0) -> None:
+        self.latency = latency  # seconds added to every response
+        self.jitter = jitter  # random extra seconds, uniformly distributed in [0, jitter]
+        self.loss = loss  # probability of closing the connection without answering
+        self.handshake_cost = handshake_cost  # extra seconds spent on every handshake
+        self.session_ttl = session_ttl  # seconds a session lives, 0 never expires
+
+    def delay(self) -> float:
+        return self.latency + random.uniform(0, self.jitter)
+
+    def drop(self) -> bool:
+        return self.loss > 0 and random.random() < self.loss
+
+# KLAP sessions
+
+def klap_auth_hash(username: str, password: str) -> bytes:
+    return sha256(hashlib.sha1(username.encode()).digest() + hashlib.sha1(password.encode()).digest())
+
+def sha256(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+class Session:
+    # Keys of a KLAP session, derived from both handshake seeds and the credentials hash
+    __slots__ = ('local_seed', 'remote_seed', 'auth_hash', 'established', 'created_at', '_key', '_iv', '_signature')
+
+    def __init__(self, local_seed: bytes, remote_seed: bytes, auth_hash: bytes) -> None:
+        self.local_seed = local_seed
+        self.remote_seed = remote_seed
+        self.auth_hash = auth_hash
+        self.established = False
+        self.created_at = time.monotonic()
+        seeds = local_seed + remote_seed + auth_hash
+        self._key = sha256(b'lsk' + seeds)[:16]
+        self._iv = sha256(b'iv' + seeds)[:12]
+        self._signature = sha256(b'ldk' + seeds)[:28]
+
+    def is_expired(self, ttl: float) -> bool:
+        return ttl > 0 and time.monotonic() - self.created_at > ttl
+
+    def server_hash(self) -> bytes:
+        return sha256(self.local_seed + self.remote_seed + self.auth_hash)
+
+    def client_hash(self) -> bytes:
+        return sha256(self.remote_seed + self.local_seed + self.auth_hash)
+
+    def encrypt(self, data: bytes, seq: int) -> bytes:
+        padder = padding.PKCS7(128).padder()
+        encryptor = self._cipher(seq).encryptor()
+        encrypted = encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+        return sha256(self._signature + seq.to_bytes(4, 'big', signed=True) + encrypted) + encrypted
+
+    def decrypt(self, data: bytes, seq: int) -> bytes:
+        unpadder = padding.PKCS7(128).unpadder()
+        decryptor = self._cipher(seq).decryptor()
+        return unpadder.update(decryptor.update(data[32:]) + decryptor.finalize()) + unpadder.finalize()
+
+    def _cipher(self, seq: int) -> Cipher:
+        return Cipher(algorithms.AES(self._key), modes.CBC(self._iv + seq.to_bytes(4, 'big', signed=True)))
+
+# Simulated light
+
+HttpResponse = Tuple[int, bytes, Dict[str, str]]
+
+class SimulatedLight:
+    # One fake light with its own state, sessions and request counters
+
+    def __init__(self, name: str, model: str, host: str, port: int, conditions: NetworkConditions,
+                 credentials: Tuple[str, str] = (DEFAULT_USERNAME, DEFAULT_PASSWORD)) -> None:
+        self.name = name
+        self.model = model
+        self.host = host
+        self.port = port
+        self.conditions = conditions
+        self.color = SIMULATED_MODELS[model] == KIND_COLOR
+        self.plug = SIMULATED_MODELS[model] == KIND_PLUG
+        self.state: Dict[str, Any] = {'device_on': False, 'brightness': 100, 'hue': 0, 'saturation': 100, 'color_temp': 2700}
+        self.stats: Dict[str, int] = {'requests': 0, 'handshakes': 0, 'dropped': 0, 'expired': 0, 'errors': 0}
+        self._auth_hash = klap_auth_hash(*credentials)
+        self._sessions: Dict[str, Session] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._device_id = secrets.token_hex(20).upper()
+        self._mac = '-'.join(f'{byte:02X}' for byte in secrets.token_bytes(6))
+
+    @property
+    def address(self) -> str:
+        return self.host if self.port == 80 else f'{self.host}:{self.port}'
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def move(self, host: str) -> None:
+        # Like a DHCP lease change: same light and port, new address, sessions are lost
+        await self.stop()
+        self._sessions.clear()
+        self.host = host
+        await self.start()
+
+    def discovery_info(self) -> Dict[str, Any]:
+        return {
+            'device_id': self._device_id,
+            'device_model': f'{self.model}(EU)',
+            'device_type': 'SMART.TAPOPLUG' if self.plug else 'SMART.TAPOBULB',
+            'ip': self.host,
+            'mac': self._mac,
+            'mgt_encrypt_schm': {'encrypt_type': 'KLAP', 'http_port': self.port, 'is_support_https': False, 'lv': 2},
+        }
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        # Open keep-alive connections are not closed by the server
+        for writer in list(self._connections):
+            writer.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections.add(writer)
+        try:
+            while (request := await read_http_request(reader)) is not None:
+                self.stats['requests'] += 1
+                await asyncio.sleep(self.conditions.delay())
+                if self.conditions.drop():
+                    self.stats['dropped'] += 1
+                    break
+                writer.write(format_http_response(*await self._handle_request(*request)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _handle_request(self, target: str, headers: Dict[str, str], body: bytes) -> HttpResponse:
+        url = urlsplit(target)
+        if url.path == '/app/handshake1':
+            return await self._handshake1(body)
+        if url.path == '/app/handshake2':
+            return self._handshake2(headers, body)
+        if url.path == '/app/request':
+            return self._request(headers, body, int(parse_qs(url.query).get('seq', ['0'])[0]))
+        # Anything else (e.g. the discovery probe of newer devices) is not spoken by bulbs
+        self.stats['errors'] += 1
+        return 200, json.dumps({'error_code': ERROR_INVALID_REQUEST}).encode(), {}
+
+    async def _handshake1(self, local_seed: bytes) -> HttpResponse:
+        self.stats['handshakes'] += 1
+        await asyncio.sleep(self.conditions.handshake_cost)
+
+        session_id = secrets.token_hex(16).upper()
+        session = Session(local_seed, secrets.token_bytes(16), self._auth_hash)
+        self._sessions[session_id] = session
+        return 200, session.remote_seed + session.server_hash(), {'Set-Cookie': f'TP_SESSIONID={session_id};TIMEOUT=86400'}
+
+    def _handshake2(self, headers: Dict[str, str], client_hash: bytes) -> HttpResponse:
+        session = self._sessions.get(parse_session_id(headers.get('cookie', '')))
+        if session is None or client_hash != session.client_hash():
+            self.stats['errors'] += 1
+            return 403, b'', {}
+        session.established = True
+        return 200, b'', {}
+
+    def _request(self, headers: Dict[str, str], body: bytes, seq: int) -> HttpResponse:
+        session_id = parse_session_id(headers.get('cookie', ''))
+        session = self._sessions.get(session_id)
+        if session is None or not session.established or session.is_expired(self.conditions.session_ttl):
+            # Real bulbs reject an expired session with a 403, the client then has to handshake again
+            self.stats['expired'] += 1
+            self._sessions.pop(session_id, None)
+            return 403, b'', {}
+
+        request = json.loads(session.decrypt(body, seq))
+        method = request.get('method')
+        if method == 'get_device_info':
+            response = {'error_code': ERROR_OK, 'result': self._device_info()}
+        elif method == 'set_device_info':
+            self._set_device_info(request.get('params', {}))
+            response = {'error_code': ERROR_OK}
+        elif method == 'component_nego':
+            response = {'error_code': ERROR_OK, 'result': self._components()}
+        else:
+            self.stats['errors'] += 1
+            response = {'error_code': ERROR_INVALID_REQUEST}
+        return 200, session.encrypt(json.dumps(response).encode(), seq), {}
+
+    def _set_device_info(self, params: Dict[str, Any]) -> None:
+        changes = {key: value for key, value in params.items() if key in self.state}
+        if self.plug:
+            changes = {key: value for key, value in changes.items() if key == 'device_on'}
+        elif not self.color:
+            changes = {key: value for key, value in changes.items() if key in ('device_on', 'brightness')}
+        if 'hue' in changes or 'saturation' in changes:
+            changes['color_temp'] = 0
+        if 'device_on' not in changes and changes:
+            # Like a real bulb, changing how it looks turns it on
+            changes['device_on'] = True
+        self.state.update(changes)
+
+    def _device_info(self) -> Dict[str, Any]:
+        info: Dict[str, Any] = {
+            'device_id': self._device_id,
+            'type': 'SMART.TAPOPLUG' if self.plug else 'SMART.TAPOBULB',
+            'model': self.model,
+            'hw_id': hashlib.md5(self.model.encode()).hexdigest().upper(),
+            'hw_ver': '1.0',
+            'fw_id': '00000000000000000000000000000000',
+            'fw_ver': '1.1.0 Build 240101 Rel.000000',
+            'oem_id': hashlib.md5(b'simulator').hexdigest().upper(),
+            'mac': self._mac,
+            'ip': self.host,
+            'ssid': base64.b64encode(b'Simulator').decode(),
+            'signal_level': 3,
+            'rssi': -40,
+            'specs': '',
+            'lang': 'en_US',
+            'device_on': self.state['device_on'],
+            'on_time': 0,
+            'overheated': False,
+            'nickname': base64.b64encode(self.name.encode()).decode(),
+            'avatar': 'plug' if self.plug else 'bulb',
+            'has_set_location_info': False,
+            'region': 'UTC',
+            'latitude': 0,
+            'longitude': 0,
+            'time_diff': 0,
+        }
+        if self.plug:
+            info.update(default_states={'type': 'last_states', 'state': {}})
+            return info
+        info.update(brightness=self.state['brightness'])
+        if self.color:
+            info.update(
+                dynamic_light_effect_enable=False,
+                hue=self.state['hue'],
+                saturation=self.state['saturation'],
+                color_temp=self.state['color_temp'],
+                color_temp_range=[2500, 6500],
+                default_states={
+                    'type': 'last_states',
+                    'state': {key: self.state[key] for key in ('brightness', 'hue', 'saturation', 'color_temp')},
+                },
+            )
+        else:
+            info.update(default_states={
+                'brightness': {'type': 'last_states', 'value': self.state['brightness']},
+                're_power_type': 'always_on',
+            })
+        return info
+
+    def _components(self) -> Dict[str, Any]:
+        components = ['device', 'default_states'] + ([] if self.plug else ['brightness'])
+        if self.color:
+            components += ['color', 'color_temperature']
+        return {'component_list': [{'id': component, 'ver_code': 1} for component in components]}
+
+# HTTP
+
+async def read_http_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, Dict[str, str], bytes]]:
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    _, target, _ = request_line.decode('latin-1').split(' ', 2)
+
+    headers: Dict[str, str] = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return target, headers, body
+
+def format_http_response(status: int, content: bytes, headers: Dict[str, str]) -> bytes:
+    reason = 'OK' if status == 200 else 'Forbidden'
+    lines = [f'HTTP/1.1 {status} {reason}', f'Content-Length: {len(content)}', 'Connection: keep-alive']
+    lines += [f'{key}: {value}' for key, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + content
+
+def parse_session_id(cookie: str) -> str:
+    for part in cookie.split(';'):
+        key, _, value = part.strip().partition('=')
+        if key == 'TP_SESSIONID':
+            return value
+    return ''
+
+# Discovery
+
+def format_discovery_response(info: Dict[str, Any]) -> bytes:
+    body = json.dumps({'error_code': ERROR_OK, 'result': info}).encode()
+    header = struct.pack('>BBHHBBI', 2, 0, 1, len(body), 17, 0, secrets.randbits(32))
+    return header + struct.pack('>I', zlib.crc32(header + b'\0' * 4 + body)) + body
+
+class DiscoveryResponder(asyncio.DatagramProtocol):
+    # Answers discovery probes for the simulated lights. Each answer is sent from the
+    # light's own address, which is what the client reports as the device's IP.
+
+    def __init__(self, simulator: 'TapoSimulator') -> None:
+        self.simulator = simulator
+        self.probes = 0
+        self._senders: Dict[str, asyncio.DatagramTransport] = {}
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if len(data) < DISCOVERY_HEADER_SIZE:
+            return
+        self.probes += 1
+        asyncio.get_running_loop().create_task(self._answer(addr))
+
+    async def _answer(self, addr: Tuple[str, int]) -> None:
+        hosts: Dict[str, SimulatedLight] = {}
+        for light in self.simulator.lights:
+            hosts.setdefault(light.host, light)
+        for host, light in hosts.items():
+            if (sender := self._senders.get(host)) is None:
+                sender, _ = await asyncio.get_running_loop().create_datagram_endpoint(asyncio.DatagramProtocol, local_addr=(host, 0))
+                self._senders[host] = sender
+            sender.sendto(format_discovery_response(light.discovery_info()), addr)
+
+    def close(self) -> None:
+        for sender in self._senders.values():
+            sender.close()
+        self._senders.clear()
+
+# Simulator
+
+class TapoSimulator:
+    # Runs a set of simulated lights on the current event loop
+
+    def __init__(self, lights: List[SimulatedLight], discovery_host: Optional[str] = None) -> None:
+        self.lights = lights
+        self.discovery_host = discovery_host  # address answering discovery probes, None disables discovery
+        self.discovery: Optional[DiscoveryResponder] = None
+        self._discovery_transport: Optional[asyncio.DatagramTransport] = None
+
+    async def start(self) -> None:
+        await asyncio.gather(*(light.start() for light in self.lights))
+        if self.discovery_host is not None:
+            self._discovery_transport, self.discovery = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: DiscoveryResponder(self), local_addr=(self.discovery_host, DISCOVERY_PORT))
+
+    async def stop(self) -> None:
+        await asyncio.gather(*(light.stop() for light in self.lights))
+        if self._discovery_transport is not None:
+            self._discovery_transport.close()
+            self.discovery.close()
+            self._discovery_transport = None
+
+    def stats(self) -> Dict[str, int]:
+        totals: Dict[str, int] = {}
+        for light in self.lights:
+            for key, value in light.stats.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def plugin_config(self) -> Dict[str, List[Dict[str, str]]]:
+        # Config file contents pointing the plugin at the simulated lights
+        config: Dict[str, List[Dict[str, str]]] = {}
+        for light in self.lights:
+            config.setdefault(light.model, []).append({'name': light.name, 'ip': light.address})
+        return config
+
+def lights_from_config(file_path: str, port: int, conditions: NetworkConditions,
+                       credentials: Tuple[str, str]) -> List[SimulatedLight]:
+    # Simulates the lights of an existing plugin config file
+    with open(file_path, 'r') as file:
+        data = yaml.safe_load(file) or {}
+
+    lights: Dict[str, SimulatedLight] = {}
+    for model, devices in data.items():
+        if model not in SIMULATED_MODELS:
+            continue
+        for device in devices or []:
+            host, _, device_port = str(device['ip']).partition(':')
+            lights[device['name']] = SimulatedLight(device['name'], model, host, int(device_port or port), conditions, credentials)
+    return list(lights.values())
+
+def generate_lights(count: int, models: List[str], host: str, base_port: int, conditions: NetworkConditions,
+                    credentials: Tuple[str, str]) -> List[SimulatedLight]:
+    # Simulates `count` lights on consecutive ports, cycling through `models`
+    return [
+        SimulatedLight(f'Sim #{index + 1}', models[index % len(models)], host, base_port + index, conditions, credentials)
+        for index in range(count)
+    ]
+
+# main
+
+async def run(simulator: TapoSimulator, stats_interval: float) -> None:
+    await simulator.start()
+    print(f'Simulating {len(simulator.lights)} lights, press Ctrl+C to stop.')
+    try:
+        while True:
+            await asyncio.sleep(stats_interval if stats_interval > 0 else 3600)
+            if stats_interval > 0:
+                print(f'Stats: {simulator.stats()}')
+    finally:
+        await simulator.stop()
+        print(f'Final stats: {simulator.stats()}')
+
+def main() -> int:
+    parser = ArgumentParser(description='Simulate Tapo lights for offline testing and load generation.')
+    parser.add_argument('--config', metavar='<file>', help='Simulate the lights of a plugin config file.')
+    parser.add_argument('--count', type=int, default=10, help='Number of lights to generate when no config is given (default 10).')
+    parser.add_argument('--models', default=','.join(SIMULATED_MODELS), help='Comma separated models to cycle through (default all).')
+    parser.add_argument('--host', default='127.0.0.1', help='Address generated lights listen on (default 127.0.0.1).')
+    parser.add_argument('--base-port', type=int, default=18000, help='Port of the first generated light (default 18000).')
+    parser.add_argument('--port', type=int, default=80, help='Port for config lights without an explicit port (default 80).')
+    parser.add_argument('--write-config', metavar='<file>', help='Write a plugin config file for the simulated lights.')
+    parser.add_argument('--username', default=DEFAULT_USERNAME, help=f'Username the plugin must use (default "{DEFAULT_USERNAME}").')
+    parser.add_argument('--password', default=DEFAULT_PASSWORD, help=f'Password the plugin must use (default "{DEFAULT_PASSWORD}").')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra seconds added to every response.')
+    parser.add_argument('--loss', type=float, default=0.0, help='Probability of dropping a request (0-1).')
+    parser.add_argument('--handshake-cost', type=float, default=0.0, help='Extra seconds spent on every handshake.')
+    parser.add_argument('--session-ttl', type=float, default=0.0, help='Seconds before a session expires (0 never).')
+    parser.add_argument('--discovery-host', metavar='<addr>', help=f'Answer discovery probes on <addr>:{DISCOVERY_PORT}, e.g. 0.0.0.0.')
+    parser.add_argument('--stats-interval', type=float, default=0.0, help='Print request stats every N seconds.')
+    opts = parser.parse_args()
+
+    models = [model.strip() for model in opts.models.split(',') if model.strip()]
+    if unknown := [model for model in models if model not in SIMULATED_MODELS]:
+        parser.error(f'unsupported models: {unknown}')
+
+    conditions = NetworkConditions(opts.latency, opts.jitter, opts.loss, opts.handshake_cost, opts.session_ttl)
+    credentials = (opts.username, opts.password)
+    if opts.config:
+        lights = lights_from_config(opts.config, opts.port, conditions, credentials)
+    else:
+        lights = generate_lights(opts.count, models, opts.host, opts.base_port, conditions, credentials)
+    simulator = TapoSimulator(lights, opts.discovery_host)
+
+    if opts.write_config:
+        with open(opts.write_config, 'w') as file:
+            yaml.safe_dump(simulator.plugin_config(), file, sort_keys=False, allow_unicode=True)
+
+    try:
+        asyncio.run(run(simulator, opts.stats_interval))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())